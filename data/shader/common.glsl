@@ -28,6 +28,7 @@ layout(std140) uniform projectionViewMatrices {
 
 layout(std140) uniform modelMatrices {
    mat4 modelMatrix;
+   vec4 uvRect; /* (u, v, width, height) of the sprite in its texture */
 };
 
 layout(std140) uniform game {
@@ -48,6 +49,14 @@ struct light_data {
 
 layout(std140) uniform light {
 	uint num_lights;
+	uint tiled;        /* if set lights are read per tile from the buffer textures below */
+	uint grid_rows;
 	vec4 ambient;
+	vec4 light_grid;   /* tile grid origin (xy), tile size and columns */
 	light_data lights[12];
 };
+
+/* tiled lights (see render/light.py light_tiles) */
+layout(binding=16) uniform samplerBuffer light_records;  /* light_data as 3 texels */
+layout(binding=17) uniform usamplerBuffer light_cells;   /* (first, count) per tile */
+layout(binding=18) uniform usamplerBuffer light_indices; /* record index */
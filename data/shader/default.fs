@@ -7,5 +7,10 @@ in vec4 w_pos;
 out vec4 ocolor;
 
 void main(){
-	ocolor = texture2D(texture0, uv);
+	vec4 texel = texture2D(texture0, uv);
+#if LIGHTING
+	ocolor = calculate_light(texel, w_pos.xy, get_normal(uv));
+#else
+	ocolor = texel;
+#endif
 }
@@ -8,7 +8,7 @@ out vec2 uv;
 out vec4 w_pos;
 
 void main(){
-	uv = in_uv;
+	uv = uvRect.xy + in_uv * uvRect.zw;
 	w_pos = modelMatrix * in_pos;
 	gl_Position = projectionViewMatrix *  w_pos;
 }
@@ -1,8 +1,28 @@
+/**
+ * Compile time switches (see Shader.load), defaults match the original:
+ *   LIGHTING    shade with the lights at all
+ *   MAX_LIGHTS  most lights read from the uniform block, at most 12 (0 skips lights entirely)
+ *   NORMAL_MAP  read normals from texture1, else the surface faces the camera
+ */
+#ifndef LIGHTING
+#define LIGHTING 0
+#endif
+#ifndef MAX_LIGHTS
+#define MAX_LIGHTS 12
+#endif
+#ifndef NORMAL_MAP
+#define NORMAL_MAP 1
+#endif
+
 /**
  * Get normal from normalmap and map to [-1..1]
  */
 vec3 get_normal(in vec2 uv){
+#if NORMAL_MAP
 	return texture2D(texture1, uv).rgb * 2.0 - 1.0;
+#else
+	return vec3(0.0, 0.0, 1.0);
+#endif
 }
 
 vec3 light_diffuse(in vec3 N, in vec3 L){
@@ -13,17 +33,57 @@ float attenuation(float light_radius, float light_falloff, float dist) {
 	return pow(max(0.0, 1.0 - (dist / light_radius)), light_falloff);
 }
 
-float light_phase(uint i){
-	return abs(sin(time * lights[i].phase_freq + lights[i].phase_offset)) * (1.0/8.0) + (7.0/8.0);
+float light_phase(in light_data light){
+	return abs(sin(time * light.phase_freq + light.phase_offset)) * (1.0/8.0) + (7.0/8.0);
+}
+
+/**
+ * Read a light record from the light_records buffer texture
+ */
+light_data fetch_light(uint i){
+	int base = int(i) * 3;
+	vec4 params = texelFetch(light_records, base + 2);
+
+	light_data light;
+	light.pos = texelFetch(light_records, base);
+	light.color = texelFetch(light_records, base + 1);
+	light.radius = params.x;
+	light.falloff = params.y;
+	light.phase_offset = params.z;
+	light.phase_freq = params.w;
+	return light;
+}
+
+vec3 shade_light(in light_data light, in vec2 P, in vec3 N){
+	vec3 dir = vec3(light.pos.xy - P, light.pos.z);
+	float distance = length(dir);
+	float attn = attenuation(light.radius, light.falloff, distance) * light_phase(light);
+	return light_diffuse(N, normalize(dir)) * light.color.rgb * attn;
 }
 
 vec4 calculate_light(in vec4 color, in vec2 P, in vec3 N){
 	vec3 acc = color.rgb * ambient.rgb;
-	for ( uint i = 0; i < num_lights; i++ ){
-		vec3 dir = vec3(lights[i].pos.xy - P, lights[i].pos.z);
-		float distance = length(dir);
-		float attn = attenuation(lights[i].radius, lights[i].falloff, distance) * light_phase(i);
-		acc += light_diffuse(N, normalize(dir)) * lights[i].color.rgb * attn;
+
+#if MAX_LIGHTS > 0
+	if ( tiled != 0u ){
+		/* only the lights reaching this tile */
+		ivec2 tile = ivec2(floor((P - light_grid.xy) / light_grid.z));
+		int cols = int(light_grid.w);
+		if ( tile.x >= 0 && tile.y >= 0 && tile.x < cols && tile.y < int(grid_rows) ){
+			uvec2 range = texelFetch(light_cells, tile.y * cols + tile.x).xy;
+			for ( uint k = 0u; k < range.y; k++ ){
+				uint i = texelFetch(light_indices, int(range.x + k)).x;
+				acc += shade_light(fetch_light(i), P, N);
+			}
+		}
+	} else {
+		/* constant bound so the loop can be unrolled */
+		for ( uint i = 0u; i < uint(MAX_LIGHTS); i++ ){
+			if ( i >= num_lights ) break;
+			acc += shade_light(lights[i], P, N);
+		}
 	}
+#endif
+
 	return vec4(acc * color.rgb, color.a);
 }
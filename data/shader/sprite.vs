@@ -0,0 +1,18 @@
+#version 330
+#include "common.glsl"
+
+layout (location=0) in vec4 in_pos;
+layout (location=1) in vec2 in_uv;
+
+/* per instance, see render/batch.py */
+layout (location=2) in mat4 in_model;   /* uses locations 2-5 */
+layout (location=6) in vec4 in_uvrect;  /* (u, v, width, height) */
+
+out vec2 uv;
+out vec4 w_pos;
+
+void main(){
+	uv = in_uvrect.xy + in_uv * in_uvrect.zw;
+	w_pos = in_model * in_pos;
+	gl_Position = projectionViewMatrix *  w_pos;
+}
@@ -0,0 +1,11 @@
+#version 430
+#include "common.glsl"
+
+in vec2 uv;
+in vec4 color;
+out vec4 ocolor;
+
+void main(){
+	/* the glyph atlas only holds coverage */
+	ocolor = vec4(color.rgb, color.a * texture2D(texture0, uv).a);
+}
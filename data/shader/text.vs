@@ -0,0 +1,15 @@
+#version 330
+#include "common.glsl"
+
+layout (location=0) in vec4 in_pos;
+layout (location=1) in vec2 in_uv;
+layout (location=2) in vec4 in_color;
+
+out vec2 uv;
+out vec4 color;
+
+void main(){
+	uv = in_uv;
+	color = in_color;
+	gl_Position = projectionViewMatrix * modelMatrix * in_pos;
+}
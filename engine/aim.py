@@ -0,0 +1,143 @@
+import math
+import time
+import numpy as np
+from item import PhysicsItem, Projectile
+from engine.projectiles import ProjectileBatch
+from utils.vector import segment_distance_many
+
+# outcome of a simulated shot
+MISS = 0
+HIT = 1      # hit the opposing catapult
+HIT_SELF = 2 # hit the own catapult first
+
+class AimSolver(object):
+    """ Finds an (angle, force) which hits the opposing catapult for a given
+    wind by simulating a grid of shots at once in a ProjectileBatch.
+
+    The first round covers the whole angle/force range and each following
+    round a finer grid around the best shot so far. The best shot is the one
+    passing closest to the target, so a shot through the middle of the target
+    is preferred over one scraping the edge. Results are cached per player
+    and wind bucket. Rounds stop when the time budget runs out, the best shot
+    found so far is returned. """
+
+    angle_range = (0.0, 90.0)   # same limits as Game.update
+    force_range = (0.0, 3000.0)
+    hit_distance = 2.5          # same as Projectile.update
+    min_traveled = 800          # hack: Projectile.update ignores hits close to the spawn
+    wind_bucket = 0.02
+    budget = 0.05               # seconds per decision
+    max_steps = 80              # 4s of flight, nearly all hits land sooner
+
+    def __init__(self, sim, grid=(16, 32), rounds=3, zoom=4.0):
+        """ grid is the number of (angles, forces) evaluated per round and zoom
+        how much smaller each round's grid is than the previous one """
+        self.sim = sim
+        self.grid = grid
+        self.rounds = rounds
+        self.zoom = zoom
+        self.cache = {}
+        n = grid[0] * grid[1]
+        self.batch = ProjectileBatch(sim.map, n, sim.camera_max + PhysicsItem.right_margin, Projectile.weight)
+
+    def bucket(self, wind):
+        return int(round(wind / self.wind_bucket))
+
+    def solve(self, player, wind, budget=None):
+        """ Returns (angle, force, hit) where hit tells if the shot is expected
+        to hit, otherwise it is the closest miss found in time. """
+        key = (player, self.bucket(wind))
+        if key in self.cache:
+            return self.cache[key]
+
+        deadline = time.time() + (budget or self.budget)
+        angles, forces = self.angle_range, self.force_range
+        best = None # (distance, angle, force, outcome)
+
+        for i in range(self.rounds):
+            a = np.linspace(angles[0], angles[1], self.grid[0])
+            f = np.linspace(forces[0], forces[1], self.grid[1])
+            a, f = [x.ravel() for x in np.meshgrid(a, f, indexing='ij')]
+
+            result = self.evaluate(player, wind, a, f, deadline)
+            if result is None:
+                break # out of time
+
+            distance, outcome = result
+            distance[outcome == HIT_SELF] = np.inf
+            k = int(np.argmin(distance))
+            if best is None or distance[k] < best[0]:
+                best = (distance[k], float(a[k]), float(f[k]), outcome[k])
+
+            # next round is centered on the best shot so far
+            da = (angles[1] - angles[0]) / self.zoom
+            df = (forces[1] - forces[0]) / self.zoom
+            angles = self.clamp_range(best[1], da, self.angle_range)
+            forces = self.clamp_range(best[2], df, self.force_range)
+
+        if best is None:
+            return None
+
+        shot = (best[1], best[2], best[3] == HIT)
+
+        # a miss found in a hurry might be improved upon next time
+        if shot[2]:
+            self.cache[key] = shot
+        return shot
+
+    @staticmethod
+    def clamp_range(center, size, limits):
+        lo = min(max(center - size * 0.5, limits[0]), limits[1] - size)
+        return lo, lo + size
+
+    def evaluate(self, player, wind, angle, force, deadline, dt=0.05):
+        """ Simulate shots with the given angle and force arrays. Returns the
+        closest distance to the target and the outcome of each shot, or None if
+        the deadline passed first. """
+        sim = self.sim
+        target = sim.catapults[1 - player].pos.xy
+        own = sim.catapults[player].pos.xy
+        spawn = sim.proj_spawn[player].xy
+
+        # same as Simulation.projectile_fire
+        a = np.radians(angle)
+        f = np.column_stack((np.cos(a) * force * 5, np.sin(a) * force * 5))
+        if player == 1:
+            f[:,0] *= -1
+
+        batch = self.batch
+        batch.clear()
+        s = batch.spawn(np.tile(spawn, (len(f), 1)), f)
+        n = s.stop
+
+        distance = np.empty(n, np.float32)
+        distance.fill(np.inf)
+        outcome = np.zeros(n, np.uint8)
+        traveled = np.zeros(n, np.float32)
+        origin = np.array(spawn, np.float32)[:,np.newaxis]
+
+        while batch.any_alive() and batch.steps < self.max_steps:
+            if time.time() > deadline:
+                return None
+            batch.step(dt, wind)
+
+            # hack: same (accumulated) distance as Projectile.traveled
+            alive = batch.alive[:n]
+            d = batch.pos[:,:n] - origin
+            traveled += np.sqrt((d * d).sum(axis=0)) * 10 * alive
+            armed = alive & (traveled > self.min_traveled)
+            if not armed.any():
+                continue
+
+            last, pos = batch.last_pos[:,:n], batch.pos[:,:n]
+            hit_own = armed & (segment_distance_many(own, last, pos) < self.hit_distance)
+            d = segment_distance_many(target, last, pos)
+            np.minimum(distance, np.where(armed, d, np.inf), out=distance)
+
+            # Projectile.update tests the catapults in order, the first hit counts
+            hits = {player: hit_own, 1 - player: armed & (d < self.hit_distance)}
+            for i in (0, 1):
+                mask = hits[i] & (outcome == MISS)
+                outcome[mask] = i == player and HIT_SELF or HIT
+
+        return distance, outcome
@@ -1,91 +1,257 @@
 import json
+import math
 import os.path
+import sys
+import traceback
 from OpenGL.GL import *
 from render.vbo import VBO
-from render.image import Image
+import render.image as image
 from render.shader import Shader
+from render.light import LightArray
 import item
 import numpy as np
 from utils.matrix import Matrix
+import utils.cache as cache
+from utils.vector import Vector2f
+
+# vertex offsets (x, y, u, v) of the four corners of a tile quad
+quad_corners = np.array([
+    (0, 0, 0, 1),
+    (1, 0, 1, 1),
+    (1, 1, 1, 0),
+    (0, 1, 0, 0),
+], np.float32)
+
+def tile_mesh(grid, width, tile_width, tile_height, chunk_size=16):
+    """ Build vertices (x, y, z, u, v) and indices for a tile layer. Empty
+    tiles (gid 0) produce no geometry.
+
+    Quads are grouped into square chunks of chunk_size tiles, stored in
+    row-major chunk order. Also returns the (first, count) index range of each
+    chunk as an array of shape (chunk rows, chunk columns, 2). """
+
+    # hardcoded
+    dx = tile_width  / 128.0
+    dy = tile_height / 128.0
+    tile_div = 128 // tile_width
+
+    height = len(grid) // width
+    chunks_x = -(-width // chunk_size)
+    chunks_y = -(-height // chunk_size)
+
+    i = np.flatnonzero(grid)
+    col = i % width
+    row = i // width
+
+    # stable sort keeps tiles row-major inside each chunk
+    chunk = (row // chunk_size) * chunks_x + (col // chunk_size)
+    order = np.argsort(chunk, kind='mergesort')
+    i, col, row = i[order], col[order], row[order]
+
+    tile = grid[i].astype(np.int64) - 1 # start with 0 index
+    n = len(i)
+
+    ver = np.empty((n, 4, 5), np.float32)
+    ver[:,:,0] = col[:,np.newaxis] + quad_corners[:,0]
+    ver[:,:,1] = -row[:,np.newaxis] + quad_corners[:,1]
+    ver[:,:,2] = 0
+    ver[:,:,3] = ((tile % tile_div)[:,np.newaxis] + quad_corners[:,2]) * dx
+    ver[:,:,4] = ((tile // tile_div)[:,np.newaxis] + quad_corners[:,3]) * dy
+
+    ind = np.arange(n*4, dtype=np.uint32)
+
+    count = np.bincount(chunk, minlength=chunks_x * chunks_y) * 4
+    ranges = np.empty((chunks_y, chunks_x, 2), np.uint32)
+    ranges[:,:,0] = (np.cumsum(count) - count).reshape(chunks_y, chunks_x)
+    ranges[:,:,1] = count.reshape(chunks_y, chunks_x)
+
+    return ver.reshape(n*4, 5), ind, ranges
+
+def tile_collidable(i):
+    """ Tell if a tile index is collidable or just decorative (works on arrays too) """
+    return (0 < i) & (i < 96)
+
+# bump when the layout of the compiled map changes
+compiled_version = 2
+compiled_arrays = ['grid', 'collision', 'vertices', 'indices', 'chunks']
+
+def compiled_path(filename, *parts):
+    # named after the path relative to data, maps in different directories can share a basename
+    name = os.path.relpath(filename, 'data').replace('/', '_').replace('\\', '_')
+    return cache.path('map', name, *parts)
+
+def compile_map(filename, chunk_size=16):
+    """ Parse a Tiled json map and write the tile grid, mesh, collision bitmap
+    and object table to the map cache. Returns the same (meta, arrays) as
+    load_compiled. """
+
+    with open(filename) as fp:
+        data = json.load(fp)
+
+    meta = {
+        'version': compiled_version,
+        'source': cache.fingerprint(filename),
+        'width': data['width'],
+        'height': data['height'],
+        'tilewidth': data['tilewidth'],
+        'tileheight': data['tileheight'],
+        'tilesets': data['tilesets'],
+        'chunk_size': chunk_size,
+        'objects': [],
+    }
+    grid = None
+
+    for layer in data['layers']:
+        name = layer['name']
+
+        if layer['type'] == 'tilelayer':
+            if grid is not None:
+                raise ValueError, 'Currently only one tile layer is supported'
+            grid = np.array(layer['data'], np.uint32)
+        elif layer['type'] == 'objectgroup':
+            meta['objects'].append((name, layer['objects']))
+
+    # a map without a tile layer gets an empty one (no geometry, nothing collides)
+    if grid is None:
+        grid = np.zeros(data['width'] * data['height'], np.uint32)
+
+    ver, ind, chunks = tile_mesh(grid, data['width'], data['tilewidth'], data['tileheight'], chunk_size)
+    arrays = {
+        'grid': grid,
+        'collision': tile_collidable(grid).reshape(data['height'], data['width']),
+        'vertices': ver,
+        'indices': ind,
+        'chunks': chunks,
+    }
+
+    # a read-only install still works, it just parses the json every time
+    try:
+        cache.makedirs(compiled_path(filename))
+        for name in compiled_arrays:
+            np.save(compiled_path(filename, name + '.npy'), arrays[name])
+        cache.write_json(compiled_path(filename, 'meta.json'), meta) # written last, marks the entry as complete
+    except (IOError, OSError):
+        traceback.print_exc()
+
+    return meta, arrays
+
+def load_compiled(filename):
+    """ Load a compiled map (arrays are memory-mapped), compiling it first if
+    the cache is missing or stale. """
+    try:
+        meta = cache.read_json(compiled_path(filename, 'meta.json'))
+        source = dict(meta['source'])
+        if meta['version'] == compiled_version and cache.fresh(meta['source'], filename):
+            arrays = dict((name, np.load(compiled_path(filename, name + '.npy'), mmap_mode='r')) for name in compiled_arrays)
+            cache.restamp(compiled_path(filename, 'meta.json'), meta, dict(meta, source=source))
+            return meta, arrays
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+
+    return compile_map(filename)
 
 class Map(object):
-    def __init__(self, filename):
+    def __init__(self, filename, headless=False):
         self.filename = os.path.join('data', filename)
 
-        with open(self.filename) as fp:
-            data = json.load(fp)
+        meta, arrays = load_compiled(self.filename)
 
-        self.vbo = None
-        self.grid = None
         self.objects = {}
-        self.width  = data['width']
-        self.height = data['height']
-        self.tile_width  = data['tilewidth']
-        self.tile_height = data['tileheight']
+        self.width  = meta['width']
+        self.height = meta['height']
+        self.tile_width  = meta['tilewidth']
+        self.tile_height = meta['tileheight']
+        self.tilesets = meta['tilesets']
         self.named_objects = {}
+        self.light_array = LightArray() # records of the map's lights, dropped with the map
+
+        # tilemap
+        self.grid = arrays['grid']
+        self.collision = arrays['collision']
+        self.vertices = arrays['vertices']
+        self.indices = arrays['indices']
+        self.chunks = arrays['chunks']
+        self.chunk_size = meta['chunk_size']
+        self.texture = []
+        self.normal = []
+        self.vbo = None
+
+        for name, objects in meta['objects']:
+            self.objects[name] = list(self.load_objects(objects))
 
-        # load tilemap
-        self.load_tileset(data['tilesets'])
+        if not headless:
+            self.attach_renderer()
 
-        for layer in data['layers']:
-            name = layer['name']
+    def attach_renderer(self):
+        """ Create textures and buffers for the map and all its objects, requires a GL context """
+        self.load_tileset(self.tilesets)
+        if len(self.indices) > 0:
+            self.vbo = VBO(GL_QUADS, self.vertices.reshape(-1), self.indices)
 
-            if layer['type'] == 'tilelayer':
-                self.load_tiles(layer)
-            elif layer['type'] == 'objectgroup':
-                self.objects[name] = list(self.load_objects(layer['objects']))
+        for objects in self.objects.itervalues():
+            for obj in objects:
+                obj.attach_renderer()
 
     def load_tileset(self, data):
         self.texture = []
         self.normal = []
         for tileset in data:
             props = tileset.get('properties', {})
-            self.texture.append(Image(tileset['image'], filter=GL_NEAREST))
-            self.normal.append(Image(props.get('normalmap', 'texture/default_normal.png'), filter=GL_NEAREST))
-
-    def load_tiles(self, layer):
-        if self.grid is not None:
-            raise ValueError, 'Currently only one tile layer is supported'
-
-        # hardcoded
-        dx = self.tile_width  / 128.0
-        dy = self.tile_height / 128.0
-        tile_div = 128 / self.tile_width
-
-        n = len(layer['data'])
-        ver = np.zeros((n*4, 5), np.float32)
-        for i, tile in enumerate(layer['data']):
-            x = i % self.width
-            y = -(i / self.width)
-
-            tile -= 1 # start with 0 index
-            tx = tile % tile_div
-            ty = tile / tile_div
-
-            ver[i*4+0] = (x  , y  , 0, tx*dx,    ty*dy+dy)
-            ver[i*4+1] = (x+1, y  , 0, tx*dx+dx, ty*dy+dy)
-            ver[i*4+2] = (x+1, y+1, 0, tx*dx+dx, ty*dy)
-            ver[i*4+3] = (x  , y+1, 0, tx*dx,    ty*dy)
-
-        ver = ver.flatten()
-        ind = np.array(range(n*4), np.uint32)
-        self.vbo = VBO(GL_QUADS, ver, ind)
-        self.grid = np.array(layer['data'], np.uint32)
+            self.texture.append(image.load(tileset['image'], filter=GL_NEAREST))
+            self.normal.append(image.load(props.get('normalmap', 'texture/default_normal.png'), filter=GL_NEAREST))
 
     def load_objects(self, src):
         for obj in src:
-            x = item.create(obj['type'], **obj)
+            x = item.create(obj['type'], light_array=self.light_array, **obj)
             if x.name != '':
                 self.named_objects[x.name] = x
             yield x
 
-    def draw(self, *args, **kwargs):
+    def visible_ranges(self, bounds):
+        """ Index ranges (first, count) of the chunks intersecting the world
+        space rectangle bounds (x0, y0, x1, y1). Adjacent chunks are merged
+        into a single range. """
+        x0, y0, x1, y1 = bounds
+        rows, cols = self.chunks.shape[:2]
+        c = self.chunk_size
+
+        # tile (col, row) covers x in [col, col+1] and y in [-row, -row+1]
+        cx0 = max(int(math.floor(x0)) // c, 0)
+        cx1 = min(int(math.floor(x1)) // c, cols - 1)
+        cy0 = max(int(math.floor(-y1)) // c, 0)
+        cy1 = min(int(math.ceil(-y0)) // c, rows - 1)
+        if cx0 > cx1 or cy0 > cy1:
+            return []
+
+        ranges = []
+        for cy in range(cy0, cy1 + 1):
+            first = int(self.chunks[cy, cx0, 0])
+            end = int(self.chunks[cy, cx1, 0] + self.chunks[cy, cx1, 1])
+            if first == end:
+                continue
+            if ranges and ranges[-1][0] + ranges[-1][1] == first:
+                ranges[-1] = (ranges[-1][0], end - ranges[-1][0])
+            else:
+                ranges.append((first, end - first))
+        return ranges
+
+    def draw(self, bounds=None):
+        """ Draw the tile layer, if bounds is given only the chunks inside it """
+        if self.vbo is None:
+            return
+
         Shader.upload_model(Matrix.identity())
         glActiveTexture(GL_TEXTURE1)
         self.normal[0].texture_bind()
         glActiveTexture(GL_TEXTURE0)
         self.texture[0].texture_bind()
-        self.vbo.draw(*args, **kwargs)
+
+        if bounds is None:
+            self.vbo.draw()
+            return
+
+        for first, count in self.visible_ranges(bounds):
+            self.vbo.draw(first, count)
 
     def get_named_item(self, name):
         return self.named_objects.get(name, None)
@@ -100,9 +266,56 @@ class Map(object):
         except IndexError:
             return -1
 
+    def cell_collidable(self, col, row):
+        """ Tell if the tile at column/row is collidable, outside of the map is empty """
+        return 0 <= col < self.width and 0 <= row < self.height and bool(self.collision[row, col])
+
+    def raycast(self, start, end):
+        """ Find the first collidable tile on the segment from start to end.
+
+        Walks every grid cell the segment passes through (Amanatides & Woo)
+        so it cannot tunnel through thin terrain however long the segment is.
+        Returns (tile, hit position) or None if nothing was hit. """
+
+        # grid space: columns grow with x and rows with -y (same as tile_at)
+        u, v = start.x, -start.y
+        du, dv = end.x - start.x, start.y - end.y
+        col, row = int(math.floor(u)), int(math.floor(v))
+        n = abs(int(math.floor(u + du)) - col) + abs(int(math.floor(v + dv)) - row)
+
+        step_c, t_max_c, t_delta_c = self.raycast_axis(u, du)
+        step_r, t_max_r, t_delta_r = self.raycast_axis(v, dv)
+
+        t = 0.0
+        for i in range(n + 1):
+            if self.cell_collidable(col, row):
+                hit = Vector2f(start.x + (end.x - start.x) * t, start.y + (end.y - start.y) * t)
+                return int(self.grid[row * self.width + col]), hit
+
+            if t_max_c < t_max_r:
+                col += step_c
+                t = t_max_c
+                t_max_c += t_delta_c
+            else:
+                row += step_r
+                t = t_max_r
+                t_max_r += t_delta_r
+
+        return None
+
+    @staticmethod
+    def raycast_axis(p, d):
+        """ Step direction, t of the first cell boundary and t between boundaries along one axis """
+        if d > 0:
+            return 1, (math.floor(p) + 1 - p) / d, 1.0 / d
+        elif d < 0:
+            return -1, (math.floor(p) - p) / d, -1.0 / d
+        else:
+            return 0, float('inf'), float('inf')
+
     def tile_collidable(self, i):
         """ Tell if a tile index is collidable or just decorative """
-        return 0 < i < 96
+        return tile_collidable(i)
 
     def tile_collision_at(self, pos):
         """ Similar to tile_at but only returns True if the tile it collides with is collidable """
@@ -110,3 +323,8 @@ class Map(object):
 
     def update(self):
         pass
+
+if __name__ == '__main__':
+    # compile step, e.g. "python -m engine.map map.json"
+    for filename in sys.argv[1:]:
+        compile_map(os.path.join('data', filename))
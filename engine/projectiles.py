@@ -0,0 +1,301 @@
+import math
+import numpy as np
+from item import PhysicsItem, Projectile
+
+# reason a projectile died
+EMPTY = 0
+TILE = 1   # hit the tilemap
+LOST = 2   # left the playable area
+
+def clearance(solid):
+    """ Chebyshev distance (in cells) from each cell to the closest solid cell
+    of a (rows, cols) bool grid, solid cells are 0. Without any solid cell
+    all cells get the grid size. """
+    rows, cols = solid.shape
+    limit = max(rows, cols)
+    dist = np.empty((rows, cols), np.float32)
+    dist.fill(limit)
+    reached = np.array(solid, np.bool_)
+    for k in range(limit):
+        dist[reached & (dist == limit)] = k
+        if not reached.any() or reached.all():
+            break
+
+        # grow by one cell in all eight directions
+        grown = reached.copy()
+        grown[1:,:] |= reached[:-1,:]
+        grown[:-1,:] |= reached[1:,:]
+        reached = grown.copy()
+        reached[:,1:] |= grown[:,:-1]
+        reached[:,:-1] |= grown[:,1:]
+    return dist
+
+class ProjectileBatch(object):
+    """ Many projectiles stored as struct-of-arrays and stepped together.
+
+    Integration, gravity, wind, impulses, tile collisions and the playable
+    area bounds follow PhysicsItem.update. Tile collisions are swept along
+    the whole step like Map.raycast, but only for projectiles which are
+    closer to a solid tile than they move this step (see clearance) and
+    have a solid tile in the cells around their step (see boxed), the rest
+    are known to be clear with a lookup or two. Dead projectiles are parked
+    with zero velocity and acceleration so the arrays never have to be
+    compacted. """
+
+    def __init__(self, map, capacity, xmax, weight=Projectile.weight, gravity=PhysicsItem.gravity,
+                 xmin=PhysicsItem.left, floor=PhysicsItem.floor):
+        """ xmax is the right edge of the playable area (game.camera_max + PhysicsItem.right_margin) """
+        self.weight = float(weight)
+        self.gravity = gravity
+        self.capacity = capacity
+        self.count = 0
+        self.steps = 0
+
+        # coordinates are stored as (2, n) so each component is contiguous
+        self.pos = np.zeros((2, capacity), np.float32)
+        self.last_pos = np.zeros((2, capacity), np.float32)
+        self.vel = np.zeros((2, capacity), np.float32)
+        self.acc = np.zeros((2, capacity), np.float32)
+        self.impulse = np.zeros((2, capacity), np.float32)
+        self.impulse_time = np.zeros(capacity, np.float64) # same rounding as PhysicsItem
+        self.alive = np.zeros(capacity, np.bool_)
+
+        # filled in when a projectile dies
+        self.hit_pos = np.zeros((2, capacity), np.float32)
+        self.hit_step = np.zeros(capacity, np.int32)
+        self.hit_reason = np.zeros(capacity, np.uint8)
+
+        self.xmin = np.float32(xmin)
+        self.xmax = np.float32(xmax)
+        self.floor = np.float32(floor)
+        self.build_grid(map)
+
+        # scratch buffers
+        self.tmp = np.zeros((2, capacity), np.float32)
+        self.live = np.zeros(capacity, np.float32) # alive as 1.0/0.0
+        self.cell = np.zeros((2, capacity), np.int32)
+        self.reach_at = np.zeros(capacity, np.float32)
+        self.none = np.zeros(0, np.intp)
+
+    def build_grid(self, map):
+        """ The collision bitmap of the map (for sweep) and a grid of how far
+        a projectile may move from each cell without reaching a solid tile
+        (clearance - 1, a bit less to make up for float32 rounding). The
+        latter covers the playable area too so live projectiles are always
+        inside it, except above. """
+        solid = np.asarray(map.collision, np.bool_)
+        self.rows, self.cols = solid.shape
+        self.solid = solid.ravel()
+
+        # summed area table, solid cells in the rectangle above and left
+        self.area = np.zeros((self.rows + 1, self.cols + 1), np.int32)
+        self.area[1:,1:] = solid.cumsum(axis=0).cumsum(axis=1)
+        self.area = self.area.ravel()
+        self.last_cell = np.array([[self.rows - 1], [self.cols - 1]], np.intp)
+
+        self.col_min = min(int(math.floor(self.xmin)), 0)
+        cols = max(int(math.floor(self.xmax)) + 1, self.cols) - self.col_min
+        rows = max(int(math.floor(-self.floor)) + 1, self.rows)
+        grid = np.zeros((rows, cols), np.bool_)
+        grid[:self.rows, -self.col_min:-self.col_min + self.cols] = solid
+        self.reach = (clearance(grid) - np.float32(1.001)).ravel()
+        self.reach_cols = cols
+
+    def spawn(self, pos, force, t=0.1):
+        """ Add projectiles at pos (k, 2) with an impulse force (k, 2) applied
+        over t seconds (same as PhysicsItem.impulse). Returns the slice of the
+        new projectiles. """
+        pos = np.asarray(pos, np.float32).reshape(-1, 2)
+        force = np.asarray(force, np.float32).reshape(-1, 2)
+        k = len(pos)
+        if self.count + k > self.capacity:
+            raise ValueError, 'Projectile batch is full (capacity: %d)' % self.capacity
+
+        s = slice(self.count, self.count + k)
+        self.pos[:,s] = pos.T
+        self.last_pos[:,s] = pos.T
+        self.vel[:,s] = 0
+        self.acc[:,s] = 0
+        self.impulse[:,s] = force.T / self.weight
+        self.impulse_time[s] = t
+        self.alive[s] = True
+        self.live[s] = 1
+        self.hit_reason[s] = EMPTY
+        self.count += k
+        return s
+
+    def clear(self):
+        self.count = 0
+        self.steps = 0
+
+    def near(self, pos, moved):
+        """ Tell which projectiles at pos moving (2, n) `moved` cells along
+        each axis might reach a solid tile. Only valid for live projectiles,
+        positions above the map are clamped to its top which only makes them
+        look closer. """
+        n = pos.shape[1]
+        x, y = pos
+        col, row = self.cell[:,:n]
+        tmp = self.reach_at[:n]
+
+        # truncation is the same as floor as long as the value is positive
+        np.subtract(x, np.float32(self.col_min), out=tmp)
+        col[...] = tmp
+        np.negative(y, out=tmp)
+        row[...] = tmp
+        np.maximum(row, 0, out=row)
+        row *= self.reach_cols
+        row += col
+        reach = self.reach.take(row, mode='clip', out=tmp)
+
+        near = moved[0] > reach
+        near |= moved[1] > reach
+        return near
+
+    def boxed(self, i, start, end):
+        """ Tell which of the segments start-end of projectiles i have a solid
+        tile in the rectangle of cells around them. The cells a segment
+        passes through are all in it, so the rest cannot hit anything. """
+        # (row, column) of the corner cells like in sweep, clamped to the map
+        a = start[::-1,i]
+        a[0] *= -1
+        b = end[::-1,i]
+        b[0] *= -1
+        lo = np.floor(np.minimum(a, b)).astype(np.intp)
+        hi = np.floor(np.maximum(a, b)).astype(np.intp)
+        np.maximum(lo, 0, out=lo)
+        np.minimum(hi, self.last_cell, out=hi)
+        hi += 1
+
+        w = self.cols + 1
+        area = self.area.take(hi[0] * w + hi[1], mode='clip')
+        area -= self.area.take(lo[0] * w + hi[1], mode='clip')
+        area -= self.area.take(hi[0] * w + lo[1], mode='clip')
+        area += self.area.take(lo[0] * w + lo[1], mode='clip')
+        return (area > 0) & (lo < hi).all(axis=0)
+
+    def sweep(self, i, start, end):
+        """ Find the first solid tile on the segments start-end of projectiles
+        i, the same cells as Map.raycast visits but all segments at once: the
+        cell boundary crossings of both axes are merged by t and give the
+        cell entered at each. Returns the projectiles which hit something and
+        the segment parameter t of each hit. """
+        m = len(i)
+
+        # grid space (row, column) like Map.raycast, rows first so they go
+        # first on ties
+        p = start[::-1,i].astype(np.float64)
+        p[0] *= -1
+        d = end[::-1,i].astype(np.float64)
+        d[0] *= -1
+        d -= p
+        cell = np.floor(p)
+        count = np.abs(np.floor(p + d) - cell).astype(np.intp)
+
+        # t of the crossings along each axis, summed up one by one like
+        # Map.raycast_axis and Map.raycast do (inf past the last one)
+        k = max(count.max(), 1)
+        t = np.empty((2, m, k))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t[:,:,0] = np.where(d > 0, cell + 1 - p, cell - p) / d
+            t[:,:,1:] = np.abs(1.0 / d)[:,:,np.newaxis]
+        np.cumsum(t, axis=2, out=t)
+        t[np.arange(k) >= count[:,:,np.newaxis]] = np.inf
+
+        # merge both axes (stable, so rows stay first on ties)
+        t = t.transpose(1, 0, 2).reshape(m, 2 * k)
+        order = np.argsort(t, axis=1, kind='mergesort')
+        t = np.hstack((np.zeros((m, 1)), t[np.arange(m)[:,np.newaxis], order]))
+
+        # the start cell and the cell entered at each crossing
+        cells = np.zeros((2,) + t.shape, np.intp)
+        cells[1,:,1:] = order >= k
+        cells[0,:,1:] = 1 - cells[1,:,1:]
+        np.cumsum(cells, axis=2, out=cells)
+        cells *= np.sign(d).astype(np.intp)[:,:,np.newaxis]
+        cells += cell.astype(np.intp)[:,:,np.newaxis]
+
+        # outside the map is empty, negative values are huge as unsigned
+        rows, cols = cells
+        solid = self.solid.take(rows * self.cols + cols, mode='clip')
+        solid &= rows.view(np.uintp) < self.rows
+        solid &= cols.view(np.uintp) < self.cols
+        solid &= t != np.inf
+
+        hit = solid.any(axis=1)
+        first = solid.argmax(axis=1)[hit]
+        return i[hit], t[hit, first]
+
+    def step(self, dt, wind):
+        """ Advance all projectiles by dt. Returns the indices of the
+        projectiles which died during this step. """
+        n = self.count
+        pos = self.pos[:,:n]
+        last = self.last_pos[:,:n]
+        vel = self.vel[:,:n]
+        acc = self.acc[:,:n]
+        alive = self.alive[:n]
+        tmp = self.tmp[:,:n]
+
+        # update position
+        last[...] = pos
+        np.multiply(acc, dt, out=tmp)
+        vel += tmp
+        np.multiply(vel, dt, out=tmp)
+        pos += tmp
+
+        # tile collisions, only projectiles that could reach a tile are swept.
+        # (flatnonzero is not cheap on large arrays even if there is nothing)
+        np.abs(tmp, out=tmp)
+        near = self.near(last, tmp)
+        near &= alive
+        tile, t = self.none, None
+        if near.any():
+            i = np.flatnonzero(near)
+            i = i[self.boxed(i, last, pos)]
+            if len(i):
+                tile, t = self.sweep(i, last, pos)
+        if len(tile):
+            a, b = last[:,tile], pos[:,tile]
+            self.hit_pos[:,tile] = a + (b - a) * t.astype(np.float32)
+            self.hit_reason[tile] = TILE
+            alive[tile] = False
+
+        # the rest dies when leaving the playable area
+        x, y = pos
+        lost = x < self.xmin
+        lost |= x > self.xmax
+        lost |= y < self.floor
+        lost &= alive
+        if lost.any():
+            lost = np.flatnonzero(lost)
+            self.hit_pos[:,lost] = pos[:,lost]
+            self.hit_reason[lost] = LOST
+        else:
+            lost = self.none
+
+        died = np.concatenate((tile, lost))
+        if len(died):
+            died.sort()
+            self.hit_step[died] = self.steps
+            alive[died] = False
+            self.live[died] = 0
+            self.impulse_time[died] = 0
+            vel[:,died] = 0
+            pos[:,died] = self.hit_pos[:,died]
+
+        # reset acceleration and impulses (dead projectiles get none)
+        live = self.live[:n]
+        np.multiply(live, np.float32(wind), out=acc[0])
+        np.multiply(live, np.float32(self.gravity), out=acc[1])
+        impulse_time = self.impulse_time[:n]
+        if impulse_time.max() > 0:
+            np.multiply(self.impulse[:,:n], impulse_time > 0, out=tmp)
+            acc += tmp
+            impulse_time -= dt
+
+        self.steps += 1
+        return died
+
+    def any_alive(self):
+        return self.alive[:self.count].any()
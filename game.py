@@ -7,19 +7,20 @@ from OpenGL.GLU import *
 
 from render.fbo import FBO
 from render.hud import HUD, ALIGN_CENTER
-from render.image import Image, Sprite
+import render.hud
 from render.shader import Shader
 from render.vbo import VBO
-from render.light import Light
+import render.vbo as vbo
+from render.batch import SpriteBatch
+from render.light import LightGrid
+from render.text import GlyphAtlas, TextRenderer
 from utils.matrix import Matrix
 from utils.vector import Vector2i, Vector2f, Vector3f
-from map import Map
+from simulation import Simulation
 from engine.camerasweep import CameraSweep
 import math
 import render.image as image
-import item
 import traceback
-import random
 
 def lerp(a, b, s):
     return a + (b - a) * s
@@ -27,24 +28,6 @@ def lerp(a, b, s):
 def clamp(a, b, c):
     return min(max(a, b), c)
 
-class DummyProjectile(object):
-    def __init__(self, delay=None):
-        self.delay = delay
-
-    def __nonzero__(self):
-        return False
-
-    def update(self, map, dt):
-        # hack to force a small delay between missing target and next player get to fire
-        if self.delay is not None:
-            self.delay -= dt
-            if self.delay <= 0:
-                game.next_player()
-                self.delay = None
-
-    def draw(self):
-        pass
-
 event_table = {}
 def event(type):
     def wrapper(func):
@@ -52,12 +35,30 @@ def event(type):
         return func
     return wrapper
 
-class Game(object):
+class Game(Simulation):
     player1_cam = Vector2f(0, -11)
     player2_cam = Vector2f(94, -11)
-    proj_spawn = [Vector2f(6, -10), Vector2f(125, -10)]
-
-    def __init__(self):
+    fov = 75
+    view_distance = 15
+    headless = False
+
+    # the simulation advances tick_dt per tick, tick_rate times a second
+    # (real time) whatever the frame rate, at most max_ticks per frame
+    tick_rate = 60
+    tick_dt = 0.05
+    max_ticks = 5
+
+    # decoded in the background from the start of init
+    textures = [
+        'texture/hud_bottom.png',
+        ('texture/sky.png', {'wrap': GL_REPEAT}),
+        ('texture/tiles.png', {'filter': GL_NEAREST}),
+        ('texture/tiles_normal.png', {'filter': GL_NEAREST}),
+        ('texture/player.png', {'filter': GL_NEAREST}),
+    ]
+
+    def __init__(self, computer=()):
+        Simulation.__init__(self, computer)
         self._running = False
         self.camera = Vector2f(0,-11)
 
@@ -80,10 +81,11 @@ class Game(object):
         glEnable(GL_BLEND)
         glBlendFunc(GL_SRC_ALPHA,GL_ONE_MINUS_SRC_ALPHA)
 
+        image.preload(Game.textures)
         image.setup()
 
         self.stage = 1
-        self.projection = Matrix.perspective(75, self.size, 0.1, 100)
+        self.projection = Matrix.perspective(self.fov, self.size, 0.1, 100)
         self.ortho = Matrix.ortho(self.size)
 
         v = np.array([
@@ -105,35 +107,33 @@ class Game(object):
                 ], np.float32)
         i = np.array([0,1,2,3], np.uint32)
         self.repquad = VBO(GL_QUADS, v, i)
-        self.parallax = Image('texture/sky.png', wrap=GL_REPEAT)
-        self.hudbg = Image('texture/hud_bottom.png')
+        self.parallax = image.load('texture/sky.png', wrap=GL_REPEAT)
+        self.hudbg = image.load('texture/hud_bottom.png')
 
         self.fbo = FBO(self.size, format=GL_RGB8, depth=True)
 
         self.shader = Shader.load('default')
         self.shader_hud = Shader.load('hud')
         self.post = Shader.load('post')
-        self.windmax = 1.0
-        self.random_wind()
 
         self.ambient_light = (1.0, 1.0, 1.0)
 
         fontsize = 16 + int(self.res_hack() * 14)
 
-        self.map = Map('map.json')
-        self.clock = pygame.time.Clock()
         self.hud_msgbox = HUD(Vector2i(500,100), 'msgbox')
-        self.hud_ui = HUD(Vector2i(self.size.x, self.size.x * (160./800)), 'ui')
+        self.ui_size = Vector2i(self.size.x, self.size.x * (160./800))
         self.scrollbar = HUD(Vector2i(self.size.x,28), 'scrollbar')
         self.font = self.hud_msgbox.create_font(size=fontsize)
-        self.font_ui = self.hud_ui.create_font(size=fontsize, font='Comic Sans MS')
-        self.camera_max = self.map.width - 38
-        self.catapults = [self.map.get_named_item('Catapult 1'), self.map.get_named_item('Catapult 2')]
+        self.font_ui = HUD.create_font(size=fontsize, font='Comic Sans MS')
+        self.text_ui = TextRenderer(GlyphAtlas(self.font_ui))
+        self.shader_text = Shader.load('text')
 
-        self.reset()
+        self.sprites = SpriteBatch()
+        self.load('map.json')
+        self.light_grid = LightGrid(self.map.objects['Lights'])
 
-        with self.hud_msgbox:
-            self.hud_msgbox.clear((0,1,1,1))
+        with self.hud_msgbox as hud:
+            hud.clear((0,1,1,1))
 
     def res_hack(self):
         """ return [0..1] based on resolution where 800 gives 0 and 1920 gives 1 """
@@ -149,32 +149,15 @@ class Game(object):
         return float(pygame.time.get_ticks()) / 1000.0
 
     def reset(self):
-        self.projectile = DummyProjectile()
-        self.angle = [60, 60]
-        self.force = [150, 150]
-        self.player = 0
-        self.firing = False
+        Simulation.reset(self)
         self.sweep = None
-        self.miss = False
         self.follow_cam = None
-        self.is_over = False
-        self.textbuf = []
         self.texttime = -10.0
-        self.catapults[0].set_loaded(True)
-        self.random_wind()
 
     @event(pygame.QUIT)
     def quit(self, event=None):
         self._running = False
 
-    def over(self):
-        self.is_over = True
-
-    def random_wind(self):
-        r = float(random.randint(0, 10000)) / 10000 # [0..1]
-        r = r * 2.0 - 1.0 # [-1..1]
-        self.wind = r * self.windmax
-
     @event(pygame.KEYDOWN)
     def on_keypress(self, event):
         if event.key == 113 and event.mod & KMOD_CTRL: # ctrl+q
@@ -186,7 +169,7 @@ class Game(object):
                 self.reset()
                 return True
         if event.key == 13: # enter
-            if not self.firing and not self.sweep:
+            if self.can_fire() and self.player not in self.computer:
                 self.projectile_fire()
 
     @event(pygame.MOUSEBUTTONDOWN)
@@ -195,49 +178,13 @@ class Game(object):
             if event.button == 4: self.camera.x += 5
             if event.button == 5: self.camera.x -= 5
 
+    def can_fire(self):
+        return not self.firing and not self.sweep
+
     def next_player(self):
-        self.player = 1 - self.player
+        Simulation.next_player(self)
         self.sweep = CameraSweep(src=self.follow_cam, dst=self.camera_targets[self.player])
         self.follow_cam = None
-        self.firing = False
-        self.random_wind()
-
-    def projectile_fire(self):
-        if not self.firing:
-            self.firing = True
-
-            a = math.radians(self.angle[self.player])
-            f = self.force[self.player] * 5
-            force = Vector2f(math.cos(a), math.sin(a)) * f
-
-            if self.player == 1:
-                force.x *= -1
-
-            p = Game.proj_spawn[self.player]
-            self.catapults[self.player].set_loaded(False)
-            self.projectile = item.create('projectile', name='projectile', x=p.x, y=p.y, flip=self.player==0)
-            self.projectile.impulse(force, 0.1)
-
-    def projectile_miss(self, projectile):
-        self.miss = True # defer so the projectile is rendered one more frame
-
-    def projectile_hit(self, hit):
-        # hack: remove all other message
-        self.textbuf = []
-
-        # hack: directly inject message
-        if self.player != hit:
-            self.text = 'Player %d hit the other player and won!' % (self.player+1)
-        else:
-            self.text = 'Player %d hit himself and lost...' % (self.player+1)
-        self.text += '\n\nPress ESC to restart.'
-
-        if hit == self.player:
-            self.catapults[self.player].set_broken()
-        else:
-            self.catapults[1-self.player].set_broken()
-
-        game.over()
 
     def poll(self):
         global event_table
@@ -248,18 +195,12 @@ class Game(object):
             func(self, event)
 
     def update(self):
+        """ One fixed tick: input and a simulation step """
         if self.is_over:
-            self.clock.tick(60)
             return
 
         key = pygame.key.get_pressed()
 
-        if self.miss:
-            self.message('Player %d missed the target' % (self.player+1,))
-            self.old_projectile = self.projectile
-            self.projectile = DummyProjectile(4)
-            self.miss = False
-
         if not self.firing and not self.sweep:
             if key[260]: self.camera.x -= 1
             if key[262]: self.camera.x += 1
@@ -273,74 +214,75 @@ class Game(object):
             self.angle[self.player] = min(max(self.angle[self.player], 0), 90)
             self.force[self.player] = min(max(self.force[self.player], 0), 3000)
 
-        dt = 1.0 / self.clock.tick(60)
-        self.map.update()
-
-        # fixed step for better physics "simulation"
-        self.projectile.update(self.map, 0.05)
+        self.step(self.tick_dt)
 
         if self.sweep:
-            self.camera, self.sweep = self.sweep.update(dt)
+            self.camera, self.sweep = self.sweep.update(self.tick_dt)
             if not self.sweep:
                 self.catapults[self.player].set_loaded(True)
 
     def render_hud(self, camera):
-        with self.hud_msgbox as hud:
-            hud.clear((0,0,0,0))
-            hud.cr.identity_matrix()
+        # each hud is only redrawn when the key of what it shows changes
+        t = pygame.time.get_ticks() / 1000.0
+        s = (t - self.texttime) / 1.8
 
-            t = pygame.time.get_ticks() / 1000.0
-            s = (t - self.texttime) / 1.8
+        if self.is_over:
+            s = 0
 
-            if self.is_over:
-                s = 0
+        message = None
+        if s > 1.0:
+            if len(self.textbuf) > 0:
+                self.texttime = t
+                self.text = self.textbuf.pop(0)
+        else:
+            a = min(1.0-s, 0.2) * 5
+            message = (self.text, int(a * 255)) # 8-bit alpha is all that shows
 
-            if s > 1.0:
-                if len(self.textbuf) > 0:
-                    self.texttime = pygame.time.get_ticks() / 1000.0
-                    self.text = self.textbuf.pop(0)
-            else:
-                a = min(1.0-s, 0.2) * 5
-                textcolor = (0,0,0,a)
+        # huds are rasterized on the worker thread, the draw functions only
+        # use the values passed to them
+        font = self.font
+        def draw_msgbox(hud):
+            hud.clear((0,0,0,0))
+            hud.cr.identity_matrix()
+
+            if message is not None:
+                text, alpha = message
                 hud.cr.translate(0,25)
-                hud.text(self.text, self.font, color=textcolor, width=hud.width, alignment=ALIGN_CENTER)
+                hud.text(text, font, color=(0,0,0,alpha / 255.0), width=hud.width, alignment=ALIGN_CENTER)
+        self.hud_msgbox.submit(message, draw_msgbox)
 
+        width = self.size.x
         visible = 34. / self.camera_max
         offset = camera.x / float(self.camera_max + 42.0)
-        with self.scrollbar as hud:
-            w = self.wind / self.windmax * 0.49
+        w = self.wind / self.windmax * 0.49
+        def draw_scrollbar(hud):
             hud.clear((1,0,1,0))
-            hud.rectangle(self.size.x * offset, 10, self.size.x * visible, 8, (0,1,1,1))
-            hud.rectangle(self.size.x * (0.5+w) - 4, 0, 8, hud.height, (1,0,0,0.8))
-
-        with self.hud_ui as hud:
-            hack = self.res_hack() * 20
-
-            hud.clear((1,1,1,0))
-            hud.cr.identity_matrix()
-            hud.cr.translate(30 + hack, 30 + hack)
-            hud.text('Player %d' % (self.player+1,), self.font_ui)
-
-            hud.cr.identity_matrix()
-            hud.cr.translate(30 + hack, 70 + hack)
-            hud.text('Angle: %3.0f' % self.angle[self.player], self.font_ui)
-
-            hud.cr.identity_matrix()
-            hud.cr.translate(30 + hack, 100 + hack)
-            hud.text('Force: %3.0f' % self.force[self.player], self.font_ui)
+            hud.rectangle(width * offset, 10, width * visible, 8, (0,1,1,1))
+            hud.rectangle(width * (0.5+w) - 4, 0, 8, hud.height, (1,0,0,0.8))
+        self.scrollbar.submit((int(width * offset), w), draw_scrollbar)
+
+        lines = [
+            'Player %d' % (self.player+1,),
+            'Angle: %3.0f' % self.angle[self.player],
+            'Force: %3.0f' % self.force[self.player],
+        ]
+        hack = self.res_hack() * 20
+        for y, line in zip((30, 70, 100), lines):
+            self.text_ui.text(line, 30 + hack, y + hack)
 
     def render_world(self, camera):
         view = Matrix.lookat(
-            camera.x + 19, camera.y, 15,
+            camera.x + 19, camera.y, self.view_distance,
             camera.x + 19, camera.y, 0,
             0,1,0)
+        bounds = self.view_bounds(camera)
 
         with self.fbo as frame:
             frame.clear(0,0.03,0.15,1)
 
             Shader.upload_projection_view(self.projection, view)
             Shader.upload_game(None)
-            Shader.upload_light(self.ambient_light, self.cull_lights())
+            Shader.upload_light(self.ambient_light, self.cull_lights(bounds), bounds)
 
             # parallax background
             pm = Matrix.transform(
@@ -355,21 +297,31 @@ class Game(object):
             Shader.upload_projection_view(self.projection, view)
 
             self.shader.bind()
-            self.map.draw()
+            self.map.draw(bounds)
 
             # entities
-            for obj in self.map.obj:
-                obj.draw()
+            self.sprites.draw(self.map.obj, bounds)
             if not self.is_over:
                 self.projectile.draw()
 
+    def view_bounds(self, camera):
+        """ World space rectangle (x0, y0, x1, y1) visible in the z=0 plane """
+        h = self.view_distance * math.tan(math.radians(self.fov) * 0.5)
+        w = h * self.size.ratio()
+        x = camera.x + 19
+        y = camera.y
+        return (x - w, y - h, x + w, y + h)
+
     def render(self):
+        image.textures.begin_frame()
+        image.poll()
+
         glClearColor(1,0,1,1)
         glClear(GL_COLOR_BUFFER_BIT|GL_DEPTH_BUFFER_BIT)
 
         camera = self.camera.copy()
         if self.projectile:
-            camera.x = min(max(self.projectile.pos.x - 19, 0), self.camera_max)
+            camera.x = min(max(self.projectile.render_pos().x - 19, 0), self.camera_max)
             self.follow_cam = camera
         elif self.follow_cam:
             camera = self.follow_cam
@@ -397,15 +349,12 @@ class Game(object):
         Shader.upload_model(pm)
         self.quad.draw()
 
-        # ui
-        pm = Matrix.transform(
-            0, self.hud_ui.height, 0,
-            self.hud_ui.width, -self.hud_ui.height, 1
-        )
-        self.hud_ui.draw()
-        self.shader_hud.bind()
+        # ui, glyph quads in pixels from the top-left
+        pm = Matrix.transform(0, self.ui_size.y, 0, 1, -1, 1)
+        self.shader_text.bind()
         Shader.upload_model(pm)
-        self.quad.draw()
+        self.text_ui.draw()
+        self.shader_hud.bind()
 
         # messagebox
         mat = Matrix.translate(self.size.x / 2 - self.hud_msgbox.width / 2, self.size.y - self.hud_msgbox.height)
@@ -419,28 +368,44 @@ class Game(object):
 
         pygame.display.flip()
 
-    def cull_lights(self):
-        return self.map.objects['Lights']
+    def cull_lights(self, bounds):
+        return self.light_grid.query(bounds)
 
     def run(self):
+        """ Main loop: updates run at the fixed tick_rate (several or none per
+        frame), frames render as fast as they can, interpolated by alpha. """
         self._running = True
+        tick = 1.0 / self.tick_rate
+        accumulator = 0.0
+        previous = self.time()
         while self.running():
             try:
+                now = self.time()
+                accumulator += now - previous
+                previous = now
+
                 self.poll()
-                self.update()
+                ticks = 0
+                while accumulator >= tick and ticks < self.max_ticks:
+                    self.update()
+                    accumulator -= tick
+                    ticks += 1
+
+                # too slow to keep up, drop the backlog instead of spiralling
+                if ticks == self.max_ticks:
+                    accumulator = min(accumulator, tick)
+
+                self.alpha = accumulator / tick
                 self.render()
             except:
                 traceback.print_exc()
 
-    def message(self, text):
-        self.textbuf.append(text)
-
-def run():
+def run(computer=()):
     pygame.display.init()
     #pygame.mixer.init(channels=3, buffer=1024)
     pygame.mouse.set_visible(True)
 
-    game = Game()
+    game = Game(computer)
 
     # superglobals for quick access
     __builtins__['game'] = game
@@ -451,6 +416,11 @@ def run():
     game.run()
 
     # force deallocation
+    render.hud.shutdown()
+    game.sprites.destroy()
+    game.text_ui.destroy()
+    game.text_ui.atlas.destroy()
     image.cleanup()
+    vbo.cleanup()
     del __builtins__['game']
     del game
@@ -1,6 +1,6 @@
 from render.shader import Shader
 from utils.matrix import Matrix
-from utils.vector import Vector2f
+from utils.vector import Vector2f, lerp2, segment_distance
 from OpenGL.GL import *
 import render.image as image
 from render.light import Light
@@ -37,6 +37,7 @@ class Item(object):
     diffuse = None # use sprite default
     normal = None  # use sprite default
     shader_name = 'default'
+    shader_defines = None # shader variant, see Shader.load
 
     def __init__(self, name, x, y, properties={}, **kwargs):
         self.name = name
@@ -50,20 +51,39 @@ class Item(object):
         if 'shader' in properties:
             self.shader_name = properties['shader']
 
+        if 'defines' in properties:
+            # e.g. "LIGHTING MAX_LIGHTS=4", see light.glsl
+            self.shader_defines = [('=' in x) and tuple(x.split('=', 1)) or x for x in properties['defines'].split()]
+
+        # set by attach_renderer
+        self.sprite = None
+        self.shader = None
+        self.instanced_shader = None
+
+    def attach_renderer(self):
+        """ Load sprite and shader, requires a GL context. Items which are only
+        simulated (headless) never call this. """
         self.load_sprite(self.diffuse, self.normal)
-        self.shader = Shader.load(self.shader_name)
+        self.shader = Shader.load(self.shader_name, defines=self.shader_defines)
+        self.instanced_shader = Shader.load(self.shader_name, vertex='sprite', defines=self.shader_defines) # used by SpriteBatch
 
         if self.shader is None:
             raise AttributeError, 'Failed to load shader %s' % self.shader_name
 
-    def model_matrix(self):
-        return Matrix.translate(self.pos.x, self.pos.y)
+    def model_matrix(self, pos=None):
+        if pos is None:
+            pos = self.pos
+        return Matrix.translate(pos.x, pos.y)
+
+    def world_matrix(self):
+        """ Model matrix to draw with """
+        return self.mat
 
     def load_sprite(self, *args, **kwargs):
         self.sprite = image.Sprite(*args, **kwargs)
 
     def draw(self):
-        Shader.upload_model(self.mat)
+        Shader.upload_model(self.world_matrix(), self.sprite.uv)
         self.shader.bind()
         self.sprite.draw()
 
@@ -75,11 +95,18 @@ class Item(object):
 
 class PhysicsItem(Item):
     weight = 1
+    gravity = -5.0
+
+    # hack: items leaving the playable area are lost
+    floor = -25
+    left = -10
+    right_margin = 32 # past game.camera_max
 
     def __init__(self, properties={}, *args, **kwargs):
         Item.__init__(self, *args, **kwargs)
         self.velocity = Vector2f(0,0)
         self.acceleration = Vector2f(0,0)
+        self.last_pos = self.pos
         self.weight = properties.get('weight', self.__class__.weight)
         self.impulses = []
 
@@ -87,28 +114,38 @@ class PhysicsItem(Item):
         Item.update(self, map, dt)
 
         # update position
-        self.velocity += self.acceleration * dt
-        self.pos += self.velocity * dt
-
-        # check for collisions (hack: or if it fell below map)
-        tile = map.tile_at(self.pos)
-        if map.tile_collidable(tile) or self.pos.y < -25:
+        self.last_pos = self.pos
+        self.velocity.iadd(self.acceleration * dt)
+        self.pos += self.velocity * dt # new vector, last_pos (and Projectile.old) keep the old one
+
+        # check for collisions along the whole step (hack: or if it fell below map)
+        hit = map.raycast(self.last_pos, self.pos)
+        if hit is not None:
+            self.pos = hit[1]
+        if hit is not None or self.pos.y < self.floor:
             self.tilemap_collision()
             return False
 
-        if self.pos.x - 32 > game.camera_max or self.pos.x < -10:
+        if self.pos.x - self.right_margin > game.camera_max or self.pos.x < self.left:
             self.tilemap_collision()
             return False
 
         # reset acceleration and impulses
-        gravity = -5.0
-        self.acceleration = sum([Vector2f(game.wind, gravity)] + [a for a,_ in self.impulses], Vector2f(0,0))
+        self.acceleration = Vector2f(game.wind, self.gravity)
+        for a,_ in self.impulses:
+            self.acceleration.iadd(a)
         self.impulses = [(a, t-dt) for a,t in self.impulses if t-dt > 0]
-
-        # update model matrix
-        self.mat = self.model_matrix()
         return True
 
+    def render_pos(self):
+        """ Position to draw at, between the last two steps (see Game.run) """
+        return lerp2(self.last_pos, self.pos, game.alpha)
+
+    def world_matrix(self):
+        # only needed when drawing so it is not updated by the simulation
+        self.mat = self.model_matrix(self.render_pos())
+        return self.mat
+
     def impulse(self, force, t=0):
         """ Applies an impulse to the object, if t > 0 it is applied over time (constant force) """
         self.impulses.append((force / self.weight, t))
@@ -133,19 +170,31 @@ class Catapult(Item):
             offset = 5
 
         self.mat = Matrix.transform(self.pos.x + offset, self.pos.y - height * (1.0/8) + 1, 0, 5 * flip, 5, 1)
-
-        self.loaded = self.sprite
-        self.unloaded = image.Sprite(diffuse=Catapult.other)
-        self.broken = image.Sprite(diffuse=Catapult.broken)
+        self.state = 'loaded'
+        self.sprites = None
+
+    def attach_renderer(self):
+        Item.attach_renderer(self)
+        self.sprites = {
+            'loaded': self.sprite,
+            'unloaded': image.Sprite(diffuse=Catapult.other),
+            'broken': image.Sprite(diffuse=Catapult.broken),
+        }
+        self.set_state(self.state)
+
+    def set_state(self, state):
+        self.state = state
+        if self.sprites is not None:
+            self.sprite = self.sprites[state]
 
     def set_loaded(self, state):
         if state:
-            self.sprite = self.loaded
+            self.set_state('loaded')
         else:
-            self.sprite = self.unloaded
+            self.set_state('unloaded')
 
     def set_broken(self):
-        self.sprite = self.broken
+        self.set_state('broken')
 
 @register_type('projectile')
 class Projectile(PhysicsItem):
@@ -157,42 +206,49 @@ class Projectile(PhysicsItem):
         self.flip = flip
         PhysicsItem.__init__(self, x=x, y=y, **kwargs)
         self.pos = Vector2f(x,y)
+        self.last_pos = self.pos
         self.old = self.pos
         self.traveled = 0
-        self.mat = self.model_matrix() # hack (position set manually)
 
-    def model_matrix(self):
+    # constant parts of the model matrix and scratch buffers for the rest
+    offset = Matrix.translate(-0.5, -0.5)
+    scale = Matrix.scale(2.2, 2.2)
+    scratch = [Matrix.identity() for i in range(3)]
+
+    def model_matrix(self, pos=None):
+        if pos is None:
+            pos = self.pos
         phase = (pygame.time.get_ticks() - self.phase) / 1000.0
         if self.flip: phase *= -1
 
-        offset = Matrix.translate(-0.5, -0.5)
-        translate = Matrix.translate(self.pos.x + 0.5, self.pos.y + 0.5)
-        scale = Matrix.scale(2.2, 2.2)
-        rotate = Matrix.rotatez(phase * 1.0)
+        translate, rotate, tmp = Projectile.scratch
+        Matrix.translate(pos.x + 0.5, pos.y + 0.5, out=translate)
+        Matrix.rotatez(phase * 1.0, out=rotate)
 
-        return np.dot(offset, np.dot(rotate, np.dot(scale, translate)))
+        Matrix.multiply(Projectile.scale, translate, out=tmp)
+        Matrix.multiply(rotate, tmp, out=translate)
+        return np.dot(Projectile.offset, translate)
 
     def tilemap_collision(self):
         game.projectile_miss(self)
 
     def update(self, map, dt):
-        # smaller timesteps
-        for q in range(10):
-            if not PhysicsItem.update(self, map, dt * 0.1):
-                break # tilemap hit detected
+        if not PhysicsItem.update(self, map, dt):
+            return # tilemap hit detected
 
-            self.traveled += (self.old - self.pos).length()
+        # hack: scaled by 10 to match what the old 10 substeps per update accumulated
+        self.traveled += (self.old - self.pos).length() * 10
 
-            if self.traveled > 800:
-                for i in range(2):
-                    d = (game.catapults[i].pos - self.pos).length()
-                    if d < 2.5:
-                        game.projectile_hit(i)
-                        break
+        if self.traveled > 800:
+            for i in range(2):
+                d = segment_distance(game.catapults[i].pos, self.last_pos, self.pos)
+                if d < 2.5:
+                    game.projectile_hit(i)
+                    break
 
 @register_type('light')
 class LightStub(Light):
-    def __init__(self, name, x, y, properties={}, **kwargs):
+    def __init__(self, name, x, y, properties={}, light_array=None, **kwargs):
         color = LightStub.parse_color(properties.get('Color', ''), (1,1,1))
         radius = LightStub.parse_float(properties.get('Radius', ''), 50)
         falloff = LightStub.parse_float(properties.get('Falloff', ''), 10)
@@ -201,9 +257,12 @@ class LightStub(Light):
         pos = Vector3f(x, -y) * (1.0 / 8)
         pos.z = 1
 
-        Light.__init__(self, pos, color, radius, falloff, phase_offset, phase_freq)
+        Light.__init__(self, pos, color, radius, falloff, phase_offset, phase_freq, array=light_array)
         self.name = name
 
+    def attach_renderer(self):
+        pass
+
     def draw(self):
         pass
 
@@ -1,6 +1,20 @@
 #!/usr/bin/env python
 
+import sys
 import game
+import render.image as image
 
 if __name__ == '__main__':
-    game.run()
+    # texture memory: "--texture-budget=MB" evicts textures past the budget,
+    # "--low-memory" loads textures at half resolution
+    for arg in sys.argv[1:]:
+        if arg.startswith('--texture-budget='):
+            image.textures.budget = int(float(arg.split('=', 1)[1]) * 1024 * 1024)
+    if '--low-memory' in sys.argv:
+        image.textures.reduce = 1
+
+    # "--computer" lets the computer play as player 2
+    game.run(computer='--computer' in sys.argv and (1,) or ())
+
+    if '--texture-report' in sys.argv:
+        print image.textures.report()
@@ -1,8 +1,8 @@
 import engine.map
 
 class Map(engine.map.Map):
-    def __init__(self, filename):
-        engine.map.Map.__init__(self, filename)
+    def __init__(self, filename, headless=False):
+        engine.map.Map.__init__(self, filename, headless)
         self.obj = self.objects['Objects']
 
     def update(self):
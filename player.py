@@ -1,7 +1,7 @@
-from render.image import Image
+import render.image as image
 from render.vbo import VBO
 from render.shader import Shader
-from utils.vector import Vector2f
+from utils.vector import Vector2f, Vector2Array
 import numpy as np
 from OpenGL.GL import *
 import math
@@ -14,10 +14,14 @@ class Player(object):
     weight = 70.0
     max_hp = 100
 
+    # safe zones (home, cave, ...) where health regenerates
+    zones = Vector2Array([(53,-8), (354,-18), (200,-48), (384,-87)])
+    zone_radius = np.array([14.0, 14.0, 17.0, 20.0], np.float32)
+
     def __init__(self, pos):
         self.pos = pos
         self.vel = Vector2f(0,0)
-        self.texture = Image('texture/player.png', filter=GL_NEAREST)
+        self.texture = image.load('texture/player.png', filter=GL_NEAREST)
         self.in_air = False
         self.jumping = 0
         self.hp = Player.max_hp
@@ -94,11 +98,9 @@ class Player(object):
             self.is_killed = True
 
         # subtract health
-        d = (self.pos - Vector2f(53,-8)).length()
-        d2 = (self.pos - Vector2f(354,-18)).length()
-        d3 = (self.pos - Vector2f(200,-48)).length()
-        d4 = (self.pos - Vector2f(384,-87)).length()
-        if d >= 14.0 and d2 >= 14.0 and d3 >= 17.0 and d4 >= 20.0:
+        zone = Player.zones.distance(self.pos)
+        d = zone[0]
+        if (zone >= Player.zone_radius).all():
             self.hp -= 1.7 * dt
         else:
             self.hp += (Player.max_hp / 100.0) * dt
@@ -112,7 +114,7 @@ class Player(object):
             self.have_sandwich = True
 
         # check cave
-        dc = (self.pos - Vector2f(354,-18)).length()
+        dc = zone[1]
         if dc < 2.0 and not self.derp:
             if not self.cave_visited:
                 if self.have_sandwich:
@@ -10,7 +10,7 @@ mkdir -p ${destdir}/datta
 cd ${destdir}
 
 rsync -avP \
-	  --exclude '*.xcf' --exclude '*.pyc' --exclude '*.tmx' --exclude release --exclude .git --exclude '*~' \
+	  --exclude '*.xcf' --exclude '*.pyc' --exclude '*.tmx' --exclude release --exclude /data/cache --exclude .git --exclude '*~' \
 	  ../../ datta/
 mv datta/README.md .
 
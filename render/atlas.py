@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Packs the sprite textures into a few atlas pages so sprites share
+textures (and batch). Diffuse and normal pages have identical layouts. The
+packed pages are kept in the cache and only rebuilt when a source changes. """
+
+import os
+import traceback
+import numpy as np
+import utils.cache as cache
+import render.texcache as texcache
+
+# not sprites: repeated, fullscreen or tilesets
+exclude = ['sky.png', 'hud_bottom.png', 'tiles.png', 'tiles_normal.png', 'default.jpg']
+default_normal = 'texture/default_normal.png'
+
+# bump when the layout of the cached atlas changes
+compiled_version = 1
+
+def compiled_path(*parts):
+    return cache.path('atlas', *parts)
+
+def decode(filename):
+    """ Load an image as a (height, width, 4) RGBA array """
+    return texcache.load(filename)[0]
+
+def normal_map(filename):
+    """ The normal map of a sprite, by name (foo.png -> foo_normal.png) """
+    base, ext = os.path.splitext(filename)
+    normal = base + '_normal' + ext
+    if os.path.exists(os.path.join('data', normal)):
+        return normal
+    return default_normal
+
+def sources(directory='texture'):
+    """ Sprite diffuse textures (relative to data) """
+    result = []
+    for name in sorted(os.listdir(os.path.join('data', directory))):
+        base, ext = os.path.splitext(name)
+        if ext != '.png' or name in exclude or base.endswith('_normal'):
+            continue
+        result.append(directory + '/' + name)
+    return result
+
+def pack(sizes, page_size, padding):
+    """ Shelf packing of (w, h) rectangles, tallest first. Returns (page, x, y)
+    of each rectangle (inside its padding) and the used height of each page. """
+    order = sorted(range(len(sizes)), key=lambda i: (-sizes[i][1], -sizes[i][0]))
+    placed = [None] * len(sizes)
+    pages = []   # used height
+    shelf = None # page, x, y, height
+    for i in order:
+        w, h = sizes[i][0] + 2 * padding, sizes[i][1] + 2 * padding
+        if w > page_size or h > page_size:
+            raise ValueError, 'Texture too large for the atlas: %dx%d' % sizes[i]
+
+        if shelf is not None and shelf[1] + w > page_size:
+            shelf = (shelf[0], 0, shelf[2] + shelf[3], 0) # next shelf
+        if shelf is None or shelf[2] + h > page_size:
+            pages.append(0)
+            shelf = (len(pages) - 1, 0, 0, 0) # next page
+
+        page, x, y, height = shelf
+        placed[i] = (page, x + padding, y + padding)
+        shelf = (page, x + w, y, max(height, h))
+        pages[page] = max(pages[page], y + h)
+    return placed, pages
+
+def blit(page, image, x, y, padding):
+    """ Copy image to page with its edges extended into the padding, so
+    linear filtering at the border does not pick up neighbours """
+    h, w = image.shape[:2]
+    page[y:y+h, x:x+w] = image
+    for i in range(1, padding + 1):
+        page[y-i, x:x+w] = image[0]
+        page[y+h-1+i, x:x+w] = image[-1]
+    page[y-padding:y+h+padding, x-padding:x] = page[y-padding:y+h+padding, x:x+1]
+    page[y-padding:y+h+padding, x+w:x+w+padding] = page[y-padding:y+h+padding, x+w-1:x+w]
+
+def build(files, page_size=2048, padding=2):
+    """ Pack files (and their normal maps) into pages. Returns (layout,
+    pages), layout maps each file to [page, x, y, w, h, normal] and pages are
+    (diffuse, normal) pairs of (height, width, 4) arrays. """
+    packed = []
+    images = []
+    normals = []
+    for filename in files:
+        diffuse = decode(filename)
+        normal_name = normal_map(filename)
+        normal = decode(normal_name)
+        if normal.shape[:2] == (1, 1):
+            normal = np.tile(normal, (diffuse.shape[0], diffuse.shape[1], 1))
+        elif normal.shape != diffuse.shape:
+            print 'atlas: %s and %s differ in size, not packed' % (filename, normal_name)
+            continue
+        packed.append(filename)
+        images.append(diffuse)
+        normals.append((normal_name, normal))
+
+    sizes = [(x.shape[1], x.shape[0]) for x in images]
+    placed, heights = pack(sizes, page_size, padding)
+
+    pages = [(np.zeros((h, page_size, 4), np.uint8), np.zeros((h, page_size, 4), np.uint8)) for h in heights]
+    layout = {}
+    for filename, diffuse, (normal_name, normal), (page, x, y) in zip(packed, images, normals, placed):
+        blit(pages[page][0], diffuse, x, y, padding)
+        blit(pages[page][1], normal, x, y, padding)
+        layout[filename] = [page, x, y, diffuse.shape[1], diffuse.shape[0], normal_name]
+    return layout, pages
+
+def compile_atlas(directory='texture', page_size=2048, padding=2):
+    """ Build the atlas of all sprites in directory and write it to the cache.
+    Returns the same (meta, pages) as load. """
+    files = sources(directory)
+    layout, pages = build(files, page_size, padding)
+
+    used = set(files) | set(normal_map(x) for x in files)
+    meta = {
+        'version': compiled_version,
+        'directory': directory,
+        'page_size': page_size,
+        'padding': padding,
+        'sources': dict((x, cache.fingerprint(os.path.join('data', x))) for x in used),
+        'layout': layout,
+        'skipped': [x for x in files if x not in layout],
+        'pages': len(pages),
+    }
+
+    # a read-only install still works, it just packs the atlas every time
+    try:
+        cache.makedirs(compiled_path())
+        for i, (diffuse, normal) in enumerate(pages):
+            np.save(compiled_path('page%d_diffuse.npy' % i), diffuse)
+            np.save(compiled_path('page%d_normal.npy' % i), normal)
+        cache.write_json(compiled_path('meta.json'), meta) # written last, marks the entry as complete
+    except (IOError, OSError):
+        traceback.print_exc()
+
+    return meta, pages
+
+def fresh(meta, directory, page_size, padding):
+    if meta['version'] != compiled_version or meta['directory'] != directory:
+        return False
+    if meta['page_size'] != page_size or meta['padding'] != padding:
+        return False
+
+    # a sprite added or removed changes the layout too
+    files = sources(directory)
+    if set(files) != set(meta['layout'].keys()) | set(meta['skipped']):
+        return False
+    return all(cache.fresh(v, os.path.join('data', k)) for k,v in meta['sources'].iteritems())
+
+def load(directory='texture', page_size=2048, padding=2):
+    """ Load the atlas (pages are memory-mapped), packing it first if the
+    cache is missing or stale. Returns (meta, pages). """
+    try:
+        meta = cache.read_json(compiled_path('meta.json'))
+        sources = dict((k, dict(v)) for k, v in meta['sources'].iteritems())
+        if fresh(meta, directory, page_size, padding):
+            pages = [(np.load(compiled_path('page%d_diffuse.npy' % i), mmap_mode='r'),
+                      np.load(compiled_path('page%d_normal.npy' % i), mmap_mode='r')) for i in range(meta['pages'])]
+            cache.restamp(compiled_path('meta.json'), meta, dict(meta, sources=sources))
+            return meta, pages
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+
+    return compile_atlas(directory, page_size, padding)
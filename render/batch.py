@@ -0,0 +1,111 @@
+from OpenGL.GL import *
+import itertools
+import numpy as np
+import render.image as image
+import render.vbo as vbo
+
+class SpriteBatch(object):
+    """ Draws many sprites with instanced rendering.
+
+    Each visible item gets one instance record (model matrix and uv rect) in
+    a shared buffer. Instances are sorted by shader and textures and each
+    such group is a single instanced draw of the sprite quad, so the number
+    of draw calls depends on the number of distinct sprites rather than the
+    number of items. Items need `sprite`, `instanced_shader` and
+    `world_matrix()` (see Item.attach_renderer). """
+
+    # per instance attributes (see data/shader/sprite.vs): mat4 and uv rect
+    format = ((2, 4), (3, 4), (4, 4), (5, 4), (6, 4))
+    floats = 16 + 4
+
+    def __init__(self, capacity=256):
+        self.buffer = glGenBuffers(1)
+        self.data = None
+        self.capacity = 0
+        self.draw_calls = 0
+        self.reserve(capacity)
+
+        # the sprite quad with the instance buffer attached
+        self.vao = glGenVertexArrays(1)
+        glBindVertexArray(self.vao)
+        image.sprite_quad.bind_buffers()
+        glBindBuffer(GL_ARRAY_BUFFER, self.buffer)
+        vbo.setup_attributes(self.format, divisor=1)
+        glBindVertexArray(0)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+    def destroy(self):
+        if self.buffer is not None:
+            glDeleteVertexArrays(1, [self.vao])
+            glDeleteBuffers(1, [self.buffer])
+            self.buffer = None
+
+    def reserve(self, n):
+        """ Make room for at least n instances """
+        if n <= self.capacity:
+            return
+
+        self.capacity = max(n, self.capacity * 2)
+        self.data = np.zeros((self.capacity, self.floats), np.float32)
+        glBindBuffer(GL_ARRAY_BUFFER, self.buffer)
+        glBufferData(GL_ARRAY_BUFFER, self.data.nbytes, None, GL_STREAM_DRAW)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+    @staticmethod
+    def visible(mats, bounds):
+        """ Tell which unit quads transformed by mats (n, 4, 4) intersect the
+        world space rectangle bounds (x0, y0, x1, y1) """
+        x0, y0, x1, y1 = bounds
+
+        # column-major: rows 0 and 1 are the transformed x and y axis
+        t = mats[:,3,:2]
+        ex = mats[:,0,:2]
+        ey = mats[:,1,:2]
+        lo = t + np.minimum(ex, 0) + np.minimum(ey, 0)
+        hi = t + np.maximum(ex, 0) + np.maximum(ey, 0)
+        return (hi[:,0] >= x0) & (lo[:,0] <= x1) & (hi[:,1] >= y0) & (lo[:,1] <= y1)
+
+    @staticmethod
+    def key(item):
+        sprite = item.sprite
+        return (id(item.instanced_shader), sprite.diffuse.id, sprite.normal.id)
+
+    def draw(self, items, bounds=None):
+        """ Draw items, if bounds is given only those inside it """
+        self.draw_calls = 0
+        items = [x for x in items if x.sprite is not None]
+        if len(items) == 0:
+            return
+
+        mats = np.array([x.world_matrix() for x in items], np.float32).reshape(-1, 4, 4)
+        if bounds is not None:
+            visible = np.flatnonzero(self.visible(mats, bounds))
+            items = [items[i] for i in visible]
+            mats = mats[visible]
+
+        n = len(items)
+        if n == 0:
+            return
+
+        keys = [self.key(x) for x in items]
+        order = sorted(range(n), key=keys.__getitem__)
+
+        self.reserve(n)
+        data = self.data[:n]
+        data[:,:16] = mats[order].reshape(n, 16)
+        data[:,16:] = [items[i].sprite.uv for i in order]
+
+        glBindBuffer(GL_ARRAY_BUFFER, self.buffer)
+        glBufferSubData(GL_ARRAY_BUFFER, 0, data.nbytes, data)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+        glBindVertexArray(self.vao)
+        first = 0
+        for key, group in itertools.groupby(order, keys.__getitem__):
+            count = len(list(group))
+            item = items[order[first]]
+            item.instanced_shader.bind()
+            item.sprite.texture_bind()
+            image.sprite_quad.draw_instanced(count, first)
+            self.draw_calls += 1
+            first += count
@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import array, math
+import math
+import threading, Queue, traceback
 import cairo, pango, pangocairo
 from OpenGL.GL import *
 from OpenGL.GLU import *
@@ -10,16 +11,24 @@ from vbo import VBO
 
 from pango import ALIGN_LEFT, ALIGN_CENTER, ALIGN_RIGHT
 
-class HUD:
-    def __init__(self, size, name):
-        self.width, self.height = size.xy
-        self.name = name # for debugging only
+def union(a, b):
+    """ Union of two (x0, y0, x1, y1) rectangles, either may be None """
+    if a is None: return b
+    if b is None: return a
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
 
-        self.data = array.array('c', chr(0) * self.width * self.height * 4)
+class Surface(object):
+    """ Cairo surface over a numpy buffer.
+
+    Drawing operations record the device rectangle they touch so only the
+    changed rectangle has to be uploaded. """
+
+    def __init__(self, width, height):
+        self.width, self.height = width, height
+        self.data = np.zeros((self.height, self.width, 4), np.uint8)
 
         stride = self.width * 4
         self.surface = cairo.ImageSurface.create_for_data(self.data, cairo.FORMAT_ARGB32, self.width, self.height, stride)
-        self.texture = glGenTextures(1);
 
         self.cr = cairo.Context(self.surface)
         self.pango = pangocairo.CairoContext(self.cr)
@@ -30,20 +39,38 @@ class HUD:
         self.font_options.set_antialias(cairo.ANTIALIAS_SUBPIXEL)
         self.cr.set_font_options(self.font_options)
 
-        glBindTexture(GL_TEXTURE_2D, self.texture);
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+        # change tracking
+        self.background = None    # last clear color
+        self.ink = None           # area drawn on since the last clear
+        self.dirty = None         # area to upload
+        self.cleared = False      # cleared since begin
 
-        v = np.array([
-                0,0,0, 0,1,
-                size.x,0,0, 1,1,
-                size.x,size.y,0, 1,0,
-                0,size.y,0, 0,0,
-                ], np.float32)
-        i = np.array([0,1,2,3], np.uint32)
-        self.vbo = VBO(GL_QUADS, v, i)
+    def begin(self):
+        self.cleared = False
+        self.cr.save()
+
+    def end(self):
+        self.cr.restore()
+        self.surface.flush()
+
+    def touch(self, x0, y0, x1, y1):
+        """ Mark a user space rectangle as drawn on """
+        corners = [self.cr.user_to_device(x, y) for x, y in ((x0, y0), (x1, y0), (x0, y1), (x1, y1))]
+        xs = [x for x, y in corners]
+        ys = [y for x, y in corners]
+
+        # pad for antialiasing
+        rect = (
+            max(int(math.floor(min(xs))) - 1, 0),
+            max(int(math.floor(min(ys))) - 1, 0),
+            min(int(math.ceil(max(xs))) + 1, self.width),
+            min(int(math.ceil(max(ys))) + 1, self.height),
+        )
+        if rect[0] >= rect[2] or rect[1] >= rect[3]:
+            return
+
+        self.ink = union(self.ink, rect)
+        self.dirty = union(self.dirty, rect)
 
     def clear(self, color=(0,0,0,0)):
         self.cr.save()
@@ -52,11 +79,14 @@ class HUD:
         self.cr.paint()
         self.cr.restore()
 
-    @classmethod
-    def create_font(cls, font='Sans', size=12, raw=None):
-        if raw is None:
-            raw = '%s %f' % (font, size)
-        return pango.FontDescription(raw)
+        # same background: only what was drawn since last clear changes
+        if color != self.background:
+            self.dirty = (0, 0, self.width, self.height)
+        else:
+            self.dirty = union(self.dirty, self.ink)
+        self.background = color
+        self.ink = None
+        self.cleared = True
 
     def text(self, text, font, color=(0,0,0,1), alignment=pango.ALIGN_LEFT, justify=False, width=None):
         cr = self.cr
@@ -73,26 +103,197 @@ class HUD:
         self.layout.set_markup(text);
         self.pango.show_layout(self.layout)
 
-        return self.layout.get_pixel_extents()
+        extents = self.layout.get_pixel_extents()
+        x, y, w, h = extents[0] # ink
+        self.touch(x, y, x + w, y + h)
+        return extents
 
     def rectangle(self, x, y, w, h, color=(0,0,0,1)):
         self.cr.save()
         self.cr.set_source_rgba(color[0], color[1], color[2], color[3])
         self.cr.rectangle(x, y, w, h)
         self.cr.fill()
+        self.touch(x, y, x + w, y + h)
         self.cr.restore()
 
+    def upload(self, texture):
+        """ Upload the dirty rectangle directly from the surface memory """
+        if self.dirty is None:
+            return
+
+        x0, y0, x1, y1 = self.dirty
+        glBindTexture(GL_TEXTURE_2D, texture)
+        glPixelStorei(GL_UNPACK_ROW_LENGTH, self.width)
+        glPixelStorei(GL_UNPACK_SKIP_PIXELS, x0)
+        glPixelStorei(GL_UNPACK_SKIP_ROWS, y0)
+        glTexSubImage2D(GL_TEXTURE_2D, 0, x0, y0, x1 - x0, y1 - y0, GL_BGRA, GL_UNSIGNED_BYTE, self.data)
+        glPixelStorei(GL_UNPACK_ROW_LENGTH, 0)
+        glPixelStorei(GL_UNPACK_SKIP_PIXELS, 0)
+        glPixelStorei(GL_UNPACK_SKIP_ROWS, 0)
+        self.dirty = None
+
+class Rasterizer(threading.Thread):
+    """ Worker thread drawing the frames submitted to HUDs """
+
+    def __init__(self):
+        threading.Thread.__init__(self, name='hud')
+        self.daemon = True
+        self.queue = Queue.Queue()
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+
+            hud, seq, func = job
+            if seq != hud.seq:
+                continue # a newer frame is already queued
+
+            try:
+                hud.rasterize(seq, func)
+            except:
+                traceback.print_exc()
+
+worker = None
+
+def shutdown():
+    """ Stop the worker thread (if started) """
+    global worker
+    if worker is None: return
+    worker.queue.put(None)
+    worker.join()
+    worker = None
+
+class HUD(object):
+    """ Texture showing one of two cairo surfaces.
+
+    Content is either drawn immediately on the shown (front) surface with
+    `with hud as surface:`, uploaded on exit, or submitted to be drawn on
+    the back surface by the worker thread, see submit. Don't mix the two
+    once submit is used. Callers can skip redrawing altogether by keying
+    the content, see changed. """
+
+    def __init__(self, size, name):
+        self.width, self.height = size.xy
+        self.name = name # for debugging only
+
+        self.surfaces = [Surface(self.width, self.height), Surface(self.width, self.height)]
+        self.front = 0            # index of the surface in the texture
+        self.texture = glGenTextures(1);
+
+        glBindTexture(GL_TEXTURE_2D, self.texture);
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, self.width, self.height, 0, GL_BGRA, GL_UNSIGNED_BYTE, self.surfaces[0].data)
+
+        self.key = object()       # content key, see changed
+
+        # frame fence: last submitted, completed (not yet shown) and shown
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.ready = None
+        self.shown = 0
+        self.waiting = None       # (seq, func) held back until ready is shown
+
+        v = np.array([
+                0,0,0, 0,1,
+                size.x,0,0, 1,1,
+                size.x,size.y,0, 1,0,
+                0,size.y,0, 0,0,
+                ], np.float32)
+        i = np.array([0,1,2,3], np.uint32)
+        self.vbo = VBO(GL_QUADS, v, i)
+
+    def changed(self, key):
+        """ Tell if content with key differs from what was last drawn (and
+        remember key), e.g. `if hud.changed((player, angle)): redraw` """
+        if key == self.key:
+            return False
+        self.key = key
+        return True
+
+    @classmethod
+    def create_font(cls, font='Sans', size=12, raw=None):
+        if raw is None:
+            raw = '%s %f' % (font, size)
+        return pango.FontDescription(raw)
+
+    def submit(self, key, func):
+        """ Redraw in the background with func(surface) if key changed. func
+        runs on the worker thread so it must only use the surface and values
+        it was given, not game state. The frame is shown by draw once
+        complete, frames older than the one shown are dropped. """
+        global worker
+        if not self.changed(key):
+            return
+
+        if worker is None:
+            worker = Rasterizer()
+            worker.start()
+
+        self.seq += 1
+        worker.queue.put((self, self.seq, func))
+
+    def rasterize(self, seq, func):
+        """ Draw frame seq on the back surface (worker thread). A completed
+        frame is never drawn over before it is shown, the job waits for
+        present instead (only the newest one is kept). Otherwise a frame
+        slower to draw than to submit would never be shown. """
+        with self.lock:
+            if self.ready is not None:
+                self.waiting = (seq, func)
+                return
+            surface = self.surfaces[1 - self.front]
+
+        surface.begin()
+        try:
+            func(surface)
+        finally:
+            surface.end()
+
+        with self.lock:
+            if seq > self.shown:
+                self.ready = seq
+
+    def present(self):
+        """ Swap in the last completed frame (if any) and upload it """
+        with self.lock:
+            if self.ready is None:
+                return
+
+            front, back = self.surfaces[self.front], self.surfaces[1 - self.front]
+
+            # the texture holds front, so what front drew has to go as well
+            if back.cleared and back.background == front.background:
+                back.dirty = union(back.dirty, front.ink)
+            else:
+                back.dirty = (0, 0, self.width, self.height)
+
+            self.front = 1 - self.front
+            self.shown = self.ready
+            self.ready = None
+            back.upload(self.texture)
+
+            waiting, self.waiting = self.waiting, None
+
+        if waiting is not None and worker is not None:
+            worker.queue.put((self,) + waiting)
+
     def __enter__(self):
-        self.cr.save()
-        return self
+        surface = self.surfaces[self.front]
+        surface.begin()
+        return surface
 
     def __exit__(self, type, value, traceback):
+        surface = self.surfaces[self.front]
+        surface.end()
         if type is None:
-            glBindTexture(GL_TEXTURE_2D, self.texture)
-            glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, self.width, self.height, 0, GL_BGRA, GL_UNSIGNED_BYTE, self.data.tostring())
+            surface.upload(self.texture)
 
     def draw(self):
+        self.present()
         glBindTexture(GL_TEXTURE_2D, self.texture)
-        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, self.width, self.height, 0, GL_BGRA, GL_UNSIGNED_BYTE, self.data.tostring())
-
         self.vbo.draw()
@@ -1,53 +1,248 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import pygame
 import traceback
 import os
+from multiprocessing.pool import ThreadPool
 from OpenGL.GL import *
 from OpenGL.GLU import *
 from render.vbo import VBO
+import render.atlas as atlas
+import render.texcache as texcache
 import numpy as np
 
 lut = {}
-def load(filename, *args, **kwargs):
-    global lut
-    if filename not in lut:
-        lut[filename] = Image(filename, *args, **kwargs)
-    return lut[filename]
+def load(filename, filter=GL_LINEAR, wrap=GL_CLAMP_TO_EDGE):
+    """ Shared Image, one per (filename, filter, wrap) as the sampler
+    state is part of the texture """
+    key = (filename, filter, wrap)
+    if key not in lut:
+        lut[key] = Image(filename, filter, wrap)
+    return lut[key]
+
+def preload(manifest):
+    """ Start decoding all textures in manifest, filenames or (filename,
+    kwargs) for load. Call as early as possible, the images are then ready
+    (or close to) by the time they are loaded. """
+    for entry in manifest:
+        if isinstance(entry, basestring):
+            entry = (entry, {})
+        filename, kwargs = entry
+        load(filename, **kwargs)
+
+mipmap_filters = (GL_NEAREST_MIPMAP_NEAREST, GL_LINEAR_MIPMAP_NEAREST, GL_NEAREST_MIPMAP_LINEAR, GL_LINEAR_MIPMAP_LINEAR)
+
+pool = None     # decoder threads, started on first use
+pending = []    # images waiting for their decoded data
+workers = 4
+
+def decode(filename, mipmaps=False, reduce=0):
+    """ Read the RGBA levels of an image (runs on the pool), see
+    texcache.load. reduce drops that many levels from the top (halving the
+    resolution each time), without mipmaps only a single level is returned. """
+    try:
+        levels = texcache.load(filename, mipmaps or reduce > 0)
+    except:
+        traceback.print_exc()
+        levels = texcache.load('texture/default.jpg', mipmaps or reduce > 0)
+
+    levels = levels[min(reduce, len(levels) - 1):]
+    return mipmaps and levels or levels[:1]
+
+class TextureManager(object):
+    """ Keeps track of the texture memory used by images.
+
+    Linearly filtered images get mipmaps (if mipmaps is set) and reduce
+    levels are skipped when loading, for low memory. When the resident
+    bytes exceed budget the least recently bound images are evicted, an
+    evicted image is reloaded (from the texture cache) when bound again.
+    Images bound during the current frame are never evicted. """
+
+    def __init__(self, budget=None, reduce=0, mipmaps=True):
+        self.budget = budget    # bytes, None for no limit
+        self.reduce = reduce
+        self.mipmaps = mipmaps
+        self.images = []
+        self.resident = 0       # bytes
+        self.frame = 0          # advanced by begin_frame
+
+    def filter(self, filter):
+        """ Filter to actually use for images asking for filter """
+        if self.mipmaps and filter == GL_LINEAR:
+            return GL_LINEAR_MIPMAP_LINEAR
+        return filter
+
+    def begin_frame(self):
+        """ Call once per rendered frame, images not bound since become
+        evictable (and are evicted if over the budget) """
+        self.frame += 1
+        if self.budget is not None and self.resident > self.budget:
+            self.evict()
+
+    def add(self, image):
+        self.images.append(image)
+
+    def uploaded(self, image, nbytes):
+        """ image now uses nbytes of texture memory """
+        grown = nbytes > image.bytes
+        self.resident += nbytes - image.bytes
+        image.bytes = nbytes
+        if grown and self.budget is not None and self.resident > self.budget:
+            self.evict(keep=image)
+
+    def evict(self, keep=None):
+        """ Evict least recently bound images until within the budget """
+        candidates = [x for x in self.images if x is not keep and x.evictable(self.frame)]
+        candidates.sort(key=lambda x: x.used)
+        for image in candidates:
+            if self.resident <= self.budget:
+                break
+            image.evict()
+
+    def report(self):
+        """ Resident bytes per image, largest first, and the total """
+        lines = ['%8.1f kB %s' % (x.bytes / 1024.0, x.filename) for x in sorted(self.images, key=lambda x: -x.bytes)]
+        lines.append('%8.1f kB total (%d textures)' % (self.resident / 1024.0, len(self.images)))
+        return '\n'.join(lines)
+
+textures = TextureManager()
+
+def poll(block=False):
+    """ Upload the images decoded so far, call from the main thread (once a
+    frame). With block all pending images are waited for. """
+    global pending
+    if not pending:
+        return
+
+    waiting = []
+    for image in pending:
+        if block or image.result.ready():
+            image.finish()
+        else:
+            waiting.append(image)
+    pending = waiting
 
 class Image(object):
+    """ Texture loaded from a file. The file is decoded in the background
+    and uploaded by poll, until then the texture is a transparent
+    placeholder (and loaded is False). Memory is managed by textures. """
+
+    placeholder = np.zeros((1, 1, 4), np.uint8)
+
     def __init__(self, filename, filter=GL_LINEAR, wrap=GL_CLAMP_TO_EDGE):
+        global pool
         self.id = glGenTextures(1)
+        self.filename = filename
+        self.filter = textures.filter(filter)
+        self.wrap = wrap
+        self.size = (1, 1)
+        self.loaded = False
+        self.resident = True
+        self.pinned = False
+        self.bytes = 0
+        self.used = textures.frame
+        textures.add(self)
+        self.upload([Image.placeholder], self.filter, wrap)
 
-        try:
-            with open(os.path.join('data', filename), 'rb') as fp:
-                surface = pygame.image.load(fp).convert_alpha()
-        except:
-            traceback.print_exc()
-            with open('data/texture/default.jpg', 'rb') as fp:
-                surface = pygame.image.load(fp).convert_alpha()
+        if pool is None:
+            pool = ThreadPool(workers)
+        self.result = pool.apply_async(decode, self.decode_args())
+        pending.append(self)
+
+    def decode_args(self):
+        return (self.filename, self.filter in mipmap_filters, textures.reduce)
 
+    def finish(self):
+        """ Wait for the decoded data and upload it """
+        if self.loaded:
+            return
         try:
-            data = pygame.image.tostring(surface, "RGBA", 0)
-
-            self.texture_bind()
-            glTexImage2D( GL_TEXTURE_2D, 0, GL_RGBA, surface.get_width(), surface.get_height(), 0, GL_RGBA, GL_UNSIGNED_BYTE, data);
-            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, wrap)
-            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, wrap)
-            glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, filter)
-            glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, filter)
+            self.upload(self.result.get(), self.filter, self.wrap)
         except Exception, e:
             traceback.print_exc()
+        self.loaded = True
+        self.result = None
+
+    @classmethod
+    def from_array(cls, data, filter=GL_LINEAR, wrap=GL_CLAMP_TO_EDGE):
+        """ Texture from a (height, width, 4) RGBA array, never evicted """
+        self = object.__new__(cls)
+        self.id = glGenTextures(1)
+        self.filename = '<array>'
+        self.loaded = True
+        self.resident = True
+        self.pinned = True
+        self.bytes = 0
+        self.used = textures.frame
+        textures.add(self)
+        self.upload([np.ascontiguousarray(data)], filter, wrap)
+        return self
+
+    def evictable(self, frame):
+        return self.loaded and self.resident and not self.pinned and self.used < frame
+
+    def evict(self):
+        """ Release the texture memory, reloaded when bound again """
+        size = self.size
+        self.resident = False
+        self.upload([Image.placeholder], self.filter, self.wrap)
+        self.size = size
+
+    def restore(self):
+        self.resident = True
+        self.upload(decode(*self.decode_args()), self.filter, self.wrap)
+
+    def upload(self, levels, filter, wrap):
+        """ Upload (height, width, 4) RGBA arrays, the base level and
+        optionally its mip chain. Memory-mapped arrays are passed through
+        without a copy. """
+        glBindTexture(GL_TEXTURE_2D, self.id)
+        for i, level in enumerate(levels):
+            glTexImage2D( GL_TEXTURE_2D, i, GL_RGBA, level.shape[1], level.shape[0], 0, GL_RGBA, GL_UNSIGNED_BYTE, level);
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAX_LEVEL, len(levels) - 1)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, wrap)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, wrap)
+        glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, filter in (GL_NEAREST, GL_NEAREST_MIPMAP_NEAREST, GL_NEAREST_MIPMAP_LINEAR) and GL_NEAREST or GL_LINEAR)
+        glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, filter)
 
-        self.size = surface.get_size()
+        self.size = (levels[0].shape[1], levels[0].shape[0])
+        textures.uploaded(self, sum(x.nbytes for x in levels))
 
     def texture_bind(self):
+        self.used = textures.frame
+        if not self.resident:
+            self.restore()
         glBindTexture(GL_TEXTURE_2D, self.id)
 
+class Atlas(object):
+    """ The sprite atlas pages as textures, see render.atlas """
+
+    def __init__(self):
+        self.meta, pages = atlas.load()
+        self.pages = [(Image.from_array(diffuse), Image.from_array(normal)) for diffuse, normal in pages]
+
+    def find(self, diffuse, normal):
+        """ (diffuse page, normal page, uv rect) of a sprite or None if it
+        is not in the atlas (with this normal map) """
+        entry = self.meta['layout'].get(diffuse)
+        if entry is None or entry[5] != normal:
+            return None
+
+        page, x, y, w, h = entry[:5]
+        d, n = self.pages[page]
+        pw, ph = d.size
+        return d, n, (x / float(pw), y / float(ph), w / float(pw), h / float(ph))
+
+sprites = None # Atlas, see setup
+
 sprite_quad = None
 def setup():
-    global sprite_quad
+    global sprite_quad, sprites
+    try:
+        sprites = Atlas()
+    except Exception:
+        traceback.print_exc() # sprites use their own textures
+
     v = np.array([
         0,0,0, 0,1,
         1,0,0, 1,1,
@@ -58,17 +253,27 @@ def setup():
     sprite_quad = VBO(GL_QUADS, v, i)
 
 def cleanup():
-    global sprite_quad
+    global sprite_quad, pool
+    if pool is not None:
+        pool.terminate()
+        pool = None
     sprite_quad.destroy()
     del sprite_quad
 
 class Sprite(Image):
+    uv = (0.0, 0.0, 1.0, 1.0) # (u, v, width, height) of the sprite in its textures
+
     def __init__(self, diffuse=None, normal=None):
         # other classes sometimes explicitly passes None as argument so cannot
         # use default arguments here
         if diffuse is None: diffuse='texture/default_diffuse.png'
         if normal is None: normal='texture/default_normal.png'
 
+        packed = sprites and sprites.find(diffuse, normal)
+        if packed:
+            self.diffuse, self.normal, self.uv = packed
+            return
+
         self.diffuse = load(diffuse)
         self.normal = load(normal)
 
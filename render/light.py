@@ -1,7 +1,68 @@
+import math
 import numpy as np
 
+class LightArray(object):
+    """ The light_data records (see common.glsl) of many lights packed in one
+    float32 array. Lights write their record when a property changes, so
+    nothing has to be rebuilt per frame. Slots changed since the last upload
+    are kept in dirty. """
+
+    record_size = 12 # floats, std140 size of light_data
+
+    def __init__(self, capacity=16):
+        self.data = np.zeros((capacity, self.record_size), np.float32)
+        self.lights = []
+        self.dirty = set()
+        self.version = 0 # bumped on every change
+
+    def __len__(self):
+        return len(self.lights)
+
+    def add(self, light):
+        """ Allocate a record for light, returns its slot """
+        slot = len(self.lights)
+        if slot == len(self.data):
+            data = np.zeros((len(self.data) * 2, self.record_size), np.float32)
+            data[:slot] = self.data
+            self.data = data
+        self.lights.append(light)
+        self.dirty.add(slot)
+        self.version += 1
+        return slot
+
+    def write(self, slot, offset, values):
+        self.data[slot, offset:offset+len(values)] = values
+        self.dirty.add(slot)
+        self.version += 1
+
+    def clean(self):
+        self.dirty.clear()
+
+# shared by all lights unless another array is given
+records = LightArray()
+
+def field(name, offset, size):
+    """ Property stored on the light which also writes `size` floats at
+    `offset` in its record """
+    attr = '_' + name
+    def get(self):
+        return getattr(self, attr)
+    def set(self, value):
+        setattr(self, attr, value)
+        values = size == 1 and (value,) or tuple(value)[:size]
+        self.array.write(self.slot, offset, values)
+    return property(get, set)
+
 class Light(object):
-    def __init__(self, pos, color, radius, falloff, phase_offset, phase_freq):
+    """ Point light. Properties must be assigned (not modified in place, e.g.
+    light.pos.x = 1) for the change to reach the shader. """
+
+    def __init__(self, pos, color, radius, falloff, phase_offset, phase_freq, array=None):
+        if array is None:
+            array = records
+        self.array = array
+        self.slot = self.array.add(self)
+
         self.pos = pos
         self.color = color
         self.radius = radius
@@ -9,11 +70,84 @@ class Light(object):
         self.phase_offset = phase_offset
         self.phase_freq = phase_freq
 
+    # layout of light_data
+    pos = field('pos', 0, 3)
+    color = field('color', 4, 3)
+    radius = field('radius', 8, 1)
+    falloff = field('falloff', 9, 1)
+    phase_offset = field('phase_offset', 10, 1)
+    phase_freq = field('phase_freq', 11, 1)
+
     def shader_data(self):
-        data = []
-        data += list((self.pos).xyz) + [0]
-        data += list(self.color) + [0]
-        data += [self.radius]
-        data += [self.falloff]
-        data += [self.phase_offset, self.phase_freq]
-        return np.array(data, np.float32)
+        """ The packed record (a view, not a copy) """
+        return self.array.data[self.slot]
+
+class LightGrid(object):
+    """ Uniform grid of the area lit by each light, for finding the lights
+    affecting a rectangle. Lights are treated as static, call rebuild after
+    moving or resizing one. """
+
+    def __init__(self, lights, cell=16.0):
+        self.cell = float(cell)
+        self.lights = list(lights)
+        self.rebuild()
+
+    def rebuild(self):
+        self.cells = {}
+        for light in self.lights:
+            r = light.radius
+            x0, y0, x1, y1 = self.cell_range(light.pos.x - r, light.pos.y - r, light.pos.x + r, light.pos.y + r)
+            for y in range(y0, y1 + 1):
+                for x in range(x0, x1 + 1):
+                    self.cells.setdefault((x, y), []).append(light)
+        self.cached = (None, ())
+
+    def cell_range(self, x0, y0, x1, y1):
+        c = self.cell
+        return int(math.floor(x0 / c)), int(math.floor(y0 / c)), int(math.floor(x1 / c)), int(math.floor(y1 / c))
+
+    def query(self, bounds):
+        """ Lights which may light the rectangle bounds (x0, y0, x1, y1), i.e.
+        share a grid cell with it. Returned as a tuple ordered by slot, which
+        is reused as long as bounds covers the same cells. """
+        key = self.cell_range(*bounds)
+        if key == self.cached[0]:
+            return self.cached[1]
+
+        x0, y0, x1, y1 = key
+        found = set()
+        for y in range(y0, y1 + 1):
+            for x in range(x0, x1 + 1):
+                found.update(self.cells.get((x, y), ()))
+
+        result = tuple(sorted(found, key=lambda light: light.slot))
+        self.cached = (key, result)
+        return result
+
+def light_tiles(lights, bounds, size):
+    """ Split bounds (x0, y0, x1, y1) into square tiles and list the lights
+    reaching each tile. Returns (columns, rows, cells, indices) where cells
+    holds (first, count) per tile (row-major from x0, y0) into indices, the
+    record slots of the lights. """
+    x0, y0, x1, y1 = bounds
+    cols = max(int(math.ceil((x1 - x0) / size)), 1)
+    rows = max(int(math.ceil((y1 - y0) / size)), 1)
+
+    slots = np.array([light.slot for light in lights], np.uint32)
+    data = lights[0].array.data[slots] if len(lights) else np.zeros((0, LightArray.record_size), np.float32)
+    px, py, radius = data[:,0], data[:,1], data[:,8]
+
+    # distance from each light to the closest point of each tile
+    half = size * 0.5
+    tx = x0 + (np.arange(cols) + 0.5) * size
+    ty = y0 + (np.arange(rows) + 0.5) * size
+    dx = np.maximum(np.abs(px - tx[:,np.newaxis]) - half, 0) # (cols, n)
+    dy = np.maximum(np.abs(py - ty[:,np.newaxis]) - half, 0) # (rows, n)
+    inside = (dx * dx)[np.newaxis,:,:] + (dy * dy)[:,np.newaxis,:] < radius * radius
+
+    cell, light = np.nonzero(inside.reshape(rows * cols, len(slots)))
+    count = np.bincount(cell, minlength=rows * cols)
+    cells = np.empty((rows * cols, 2), np.uint32)
+    cells[:,0] = np.cumsum(count) - count
+    cells[:,1] = count
+    return cols, rows, cells, slots[light]
@@ -1,10 +1,17 @@
 import re
+import os
+import hashlib
+import traceback
 from OpenGL.GL import *
+from OpenGL.error import GLError
 from OpenGL.GLU import *
 from OpenGL.GL.ARB.uniform_buffer_object import *
 from os.path import exists, join
 import numpy as np
 import pygame
+from render.tbo import TBO
+from render.light import light_tiles
+import utils.cache as cache
 
 file_counter = 1
 file_lut = {}
@@ -26,8 +33,22 @@ def file_reverse(id):
         if v == id: return k
     raise KeyError, 'No file with id %d' % id
 
-def preprocess(source, parent_id):
-    global re_inc, file_lut
+def define_key(defines):
+    """ Normalize defines, a dict or names and (name, value) pairs, to a
+    sorted tuple of (name, value) strings """
+    if not defines:
+        return ()
+    if isinstance(defines, dict):
+        items = defines.items()
+    else:
+        items = [isinstance(x, basestring) and (x, 1) or tuple(x) for x in defines]
+    return tuple(sorted((str(k), str(v)) for k,v in items))
+
+def preprocess(source, parent, defines=()):
+    """ Resolve includes, defines (see define_key) go right after #version.
+    Yields the lines, with (line, filename) in place of #line markers, see
+    expand """
+    global re_inc
 
     for i, line in enumerate(source.splitlines()):
         line = line.strip()
@@ -35,71 +56,277 @@ def preprocess(source, parent_id):
         # hack to put a #line marker after #version so errors is marked correctly
         if i == 0 and line[:8] == '#version':
             yield line
-            yield '#line %d %s' % (2, parent_id)
+            for name, value in defines:
+                yield '#define %s %s' % (name, value)
+            yield (2, parent)
             continue
 
         match = re_inc.match(line)
         if match:
             filename = join('data/shader', match.group(1))
-            id = file_id(filename)
             with open(filename) as fp:
-                yield '#line %d %s' % (1, id)
-                for x in preprocess(fp.read(), id):
+                yield (1, filename)
+                for x in preprocess(fp.read(), filename):
                     yield x
-                yield '#line %d %d' % (i+2, parent_id)
+                yield (i+2, parent)
         else:
             yield line
 
+def expand(lines, marker):
+    """ Source text of preprocessed lines, marker(line, filename) writes the
+    #line markers """
+    return '\n'.join(isinstance(x, tuple) and marker(*x) or x for x in lines)
+
+def line_marker(line, filename):
+    # GLSL only takes numbers, mapped back by print_log
+    return '#line %d %d' % (line, file_id(filename))
+
+def key_marker(line, filename):
+    # file ids depend on the load order, the program key must not
+    return '#line %d "%s"' % (line, filename)
+
+# linked programs are cached with glGetProgramBinary, keyed by the source
+# and the driver, so only the first start compiles anything
+binary_cache = True
+binary_num_formats = None
+
+def binary_formats():
+    """ Tell if the driver supports program binaries at all """
+    global binary_num_formats
+    if binary_num_formats is None:
+        binary_num_formats = binary_cache and glGetIntegerv(GL_NUM_PROGRAM_BINARY_FORMATS) or 0
+    return binary_num_formats > 0
+
+def program_key(sources):
+    h = hashlib.sha1()
+    for what in (GL_VENDOR, GL_RENDERER, GL_VERSION):
+        h.update(glGetString(what) or '')
+        h.update('\0')
+    for source in sources:
+        h.update(source)
+        h.update('\0')
+    return h.hexdigest()
+
+def binary_path(key, ext):
+    return cache.path('shader', key + ext)
+
+def load_binary(key):
+    """ Program from the binary cache, None if missing or rejected """
+    if not binary_formats():
+        return None
+
+    try:
+        meta = cache.read_json(binary_path(key, '.json'))
+        with open(binary_path(key, '.bin'), 'rb') as fp:
+            binary = np.fromstring(fp.read(), np.uint8)
+    except (IOError, OSError, ValueError):
+        return None
+
+    sp = glCreateProgram()
+    try:
+        glProgramBinary(sp, meta['format'], binary, len(binary))
+        if glGetProgramiv(sp, GL_LINK_STATUS):
+            return sp
+    except (GLError, KeyError):
+        pass
+
+    # e.g. a driver update, compiled again and overwritten
+    glDeleteProgram(sp)
+    return None
+
+def save_binary(key, sp):
+    if not binary_formats():
+        return
+
+    try:
+        length = glGetProgramiv(sp, GL_PROGRAM_BINARY_LENGTH)
+        binary = np.zeros(length, np.uint8)
+        written = np.zeros(1, np.int32)
+        format = np.zeros(1, np.uint32)
+        glGetProgramBinary(sp, length, written, format, binary)
+
+        cache.makedirs(cache.path('shader'))
+        tmp = binary_path(key, '.%d.tmp' % os.getpid())
+        with open(tmp, 'wb') as fp:
+            fp.write(binary[:written[0]].tostring())
+        os.rename(tmp, binary_path(key, '.bin'))
+        cache.write_json(binary_path(key, '.json'), {'format': int(format[0])}) # written last, marks the entry as complete
+    except (GLError, IOError, OSError):
+        traceback.print_exc()
+
+# std140 (size, alignment, dtype, components) of the types used in blocks
+std140_types = {
+    'float':      (4,  4,  np.float32, 1),
+    'uint':       (4,  4,  np.uint32,  1),
+    'int':        (4,  4,  np.int32,   1),
+    'vec2':       (8,  8,  np.float32, 2),
+    'vec3':       (12, 16, np.float32, 3),
+    'vec4':       (16, 16, np.float32, 4),
+    'mat4':       (64, 16, np.float32, 16),
+    'light_data': (48, 16, np.float32, 12), # struct in common.glsl
+}
+
+def align(offset, alignment):
+    return (offset + alignment - 1) // alignment * alignment
+
+def std140_layout(fields):
+    """ Offsets of the (name, type[, count]) fields of a block. Returns a dict
+    name -> (offset, stride, count, dtype, components) and the block size. """
+    layout = {}
+    offset = 0
+    for field in fields:
+        name, type = field[:2]
+        count = len(field) > 2 and field[2] or None
+        size, alignment, dtype, n = std140_types[type]
+
+        # array elements are aligned (and padded) to vec4
+        if count is not None:
+            alignment = align(alignment, 16)
+            stride = align(size, 16)
+        else:
+            stride = size
+
+        offset = align(offset, alignment)
+        layout[name] = (offset, stride, count, dtype, n)
+        offset += stride * (count or 1)
+    return layout, align(offset, 16)
+
 class UniformBlock(object):
+    """ Uniform buffer with a CPU side shadow copy laid out per std140.
+
+    Fields are written to the shadow with set (or block[name] = value) and
+    only the changed byte range is uploaded by flush, writing a value equal
+    to what is already there is free. """
+
     counter = 0
 
-    def __init__(self, name, size, usage=GL_DYNAMIC_DRAW):
+    def __init__(self, name, fields, usage=GL_DYNAMIC_DRAW):
         self.id = glGenBuffers(1)
         self.name = name
-        self.size = size
+        self.layout, self.size = std140_layout(fields)
         self.usage = usage
         self.binding = UniformBlock.counter
         UniformBlock.counter += 1
 
+        self.shadow = np.zeros(self.size, np.uint8)
+        self.views = dict((k, self.field_view(*v)) for k,v in self.layout.iteritems())
+        self.dirty = None # (begin, end) byte range
+
         with self:
-            glBufferData(GL_UNIFORM_BUFFER, self.size, None, usage)
+            glBufferData(GL_UNIFORM_BUFFER, self.size, self.shadow, usage)
             glBindBufferRange(GL_UNIFORM_BUFFER, self.binding, self.id, 0, self.size)
 
+    def field_view(self, offset, stride, count, dtype, n):
+        """ Typed view of a field in the shadow, (n,) or (count, n) for arrays """
+        itemsize = np.dtype(dtype).itemsize
+        if count is None:
+            return np.ndarray((n,), dtype, self.shadow.data, offset)
+        return np.ndarray((count, n), dtype, self.shadow.data, offset, (stride, itemsize))
+
     def __enter__(self):
         glBindBuffer(GL_UNIFORM_BUFFER, self.id)
 
     def __exit__(self, type, value, traceback):
-        glBindBuffer(GL_UNIFORM_BUFFER, self.id)
+        glBindBuffer(GL_UNIFORM_BUFFER, 0)
+
+    def __setitem__(self, name, value):
+        self.set(name, value)
+
+    def set(self, name, value, index=None):
+        """ Write a field (or element index of an array field). Shorter values
+        only write the leading components, e.g. rgb of a vec4. """
+        view = self.views[name]
+        if index is not None:
+            view = view[index]
+        value = np.asarray(value, view.dtype).reshape(-1)
+        if view.ndim == 1:
+            view = view[:len(value)]
+        else:
+            value = value.reshape(-1, view.shape[1])
+
+        if np.array_equal(view, value):
+            return
+
+        view[...] = value
+        offset, stride, count, dtype, n = self.layout[name]
+        if index is not None:
+            offset += stride * index
+        begin = offset
+        end = offset + (view.ndim == 1 and view.nbytes or stride * len(view))
+        self.mark(begin, end)
+
+    def mark(self, begin, end):
+        """ Mark a byte range of the shadow as changed """
+        if self.dirty is None:
+            self.dirty = (begin, end)
+        else:
+            self.dirty = (min(self.dirty[0], begin), max(self.dirty[1], end))
 
-    def upload(self, *args):
+    def flush(self):
+        """ Upload the changed range (if any) in a single call """
+        if self.dirty is None:
+            return
+        begin, end = self.dirty
         with self:
-            for offset, size, value in args:
-                glBufferSubData(GL_UNIFORM_BUFFER, offset, size, value);
+            glBufferSubData(GL_UNIFORM_BUFFER, begin, end - begin, self.shadow[begin:end])
+        self.dirty = None
+
+    def upload(self, *args):
+        """ Raw (offset, size, value) writes, flushed immediately """
+        for offset, size, value in args:
+            data = np.asarray(value).view(np.uint8).reshape(-1)[:size]
+            self.shadow[offset:offset+size] = data
+            self.mark(offset, offset + size)
+        self.flush()
 
 class Shader(object):
-    max_lights = 12 # hardcoded in common.glsl
-    light_size = 12 # defined in common.glsl
+    max_lights = 12 # hardcoded in common.glsl, more lights are tiled
+    light_tile_size = 4.0 # world units
 
     uproj = None
     umodel = None
     ugame = None
     ulight = None
+    uploaded_lights = [] # lights currently in ulight, in order
+    light_buffers = None
+    light_units = (16, 17, 18) # bindings of the light buffer textures in common.glsl
+    light_tiling = True # False if the light units are not available, see initialize
+    light_tiles_key = None
     lut = {}
 
     @classmethod
-    def load(cls, filename):
-        if filename not in cls.lut:
-            cls.lut[filename] = Shader(filename)
-        return cls.lut[filename]
-
-    def __init__(self, name):
+    def load(cls, filename, vertex=None, defines=None):
+        """ Load (or reuse) a program, vertex selects another vertex shader
+        than the one with the same name (e.g. 'sprite' for instancing).
+        defines compiles a variant, e.g. {'LIGHTING': 1, 'MAX_LIGHTS': 4}
+        (see light.glsl for the switches). """
+        defines = define_key(defines)
+        key = (filename, vertex, defines)
+        if key not in cls.lut:
+            cls.lut[key] = Shader(filename, vertex, defines)
+        return cls.lut[key]
+
+    def __init__(self, name, vertex=None, defines=()):
         self.initialize()
-
-        self.sp = glCreateProgram()
-        self.add_shader(name, '.vs', GL_VERTEX_SHADER)
-        self.add_shader(name, '.fs', GL_FRAGMENT_SHADER)
-        glLinkProgram(self.sp)
-        self.print_log(self.sp)
+        self.defines = define_key(defines)
+
+        sources = [
+            (self.source(vertex or name, '.vs'), GL_VERTEX_SHADER),
+            (self.source(name, '.fs'), GL_FRAGMENT_SHADER),
+        ]
+
+        key = program_key([expand(lines, key_marker) for lines, type in sources])
+        self.sp = load_binary(key)
+        if self.sp is None:
+            self.sp = glCreateProgram()
+            for lines, type in sources:
+                self.add_shader(expand(lines, line_marker), type)
+            if binary_formats():
+                glProgramParameteri(self.sp, GL_PROGRAM_BINARY_RETRIEVABLE_HINT, GL_TRUE)
+            glLinkProgram(self.sp)
+            self.print_log(self.sp)
+            if glGetProgramiv(self.sp, GL_LINK_STATUS):
+                save_binary(key, self.sp)
 
         self.bind()
 
@@ -112,18 +339,19 @@ class Shader(object):
 
         self.unbind()
 
-    def add_shader(self, filename, ext, type):
-        shader = glCreateShader(type)
-
+    def source(self, filename, ext):
+        """ Preprocessed lines of a stage (see preprocess), the default one
+        if missing """
         fullpath = join('data/shader', filename) + ext
         if not exists(fullpath):
             assert filename != 'default'
-            return self.add_shader('default', ext, type)
+            return self.source('default', ext)
 
         with open(fullpath) as fp:
-            id = file_id(fullpath)
-            source = '\n'.join(preprocess(fp.read(), id))
+            return list(preprocess(fp.read(), fullpath, self.defines))
 
+    def add_shader(self, source, type):
+        shader = glCreateShader(type)
         glShaderSource(shader, source)
         glCompileShader(shader)
         glAttachShader(self.sp, shader)
@@ -157,51 +385,130 @@ class Shader(object):
 
     @staticmethod
     def upload_projection_view(proj, view):
-        pv = np.matrix(view) * np.matrix(proj)
+        pv = np.dot(view, proj)
 
-        s = 4*16
-        Shader.uproj.upload(
-            (0*s, s, pv),
-            (1*s, s, proj),
-            (2*s, s, view))
+        block = Shader.uproj
+        block['projectionViewMatrix'] = pv
+        block['projectionMatrix'] = proj
+        block['viewMatrix'] = view
+        block.flush()
 
     @staticmethod
-    def upload_model(mat):
-        s = 4*16
-        Shader.umodel.upload((0*s, s, mat))
+    def upload_model(mat, uv=(0.0, 0.0, 1.0, 1.0)):
+        """ uv is the (u, v, width, height) rect sampled, e.g. Sprite.uv """
+        block = Shader.umodel
+        block['modelMatrix'] = mat
+        block['uvRect'] = uv
+        block.flush()
 
     @staticmethod
     def upload_game(player):
-        Shader.ugame.upload((0,   4*2, np.array([0,0], np.float32)))
-        Shader.ugame.upload((4*2, 4*1, np.array(pygame.time.get_ticks() / 1000.0, np.float32)))
-        Shader.ugame.upload((4*3, 4*1, np.array(0, np.float32)))
-        Shader.ugame.upload((4*4, 4*1, np.array(0, np.float32)))
+        block = Shader.ugame
+        block['player_pos'] = (0, 0)
+        block['time'] = pygame.time.get_ticks() / 1000.0
+        block['hp'] = 0
+        block['fade'] = 0
+        block.flush()
 
     @staticmethod
-    def upload_light(ambient, lights):
-        if len(lights) > Shader.max_lights:
-            raise ValueError, 'Too many lights uploaded (max: %d, got: %d)' % (Shader.max_ligths, len(lights))
+    def upload_light(ambient, lights, bounds=None):
+        """ Upload the lights for the area bounds (x0, y0, x1, y1). Up to
+        max_lights are stored in the uniform block, past that all records
+        go to a buffer texture and each tile of bounds gets its own list. """
+        block = Shader.ulight
+        block['ambient'] = ambient
 
-        Shader.ulight.upload((4*0, 4*1, np.array(len(lights), np.uint32)))
-        Shader.ulight.upload((4*4, 4*3, np.array(ambient, np.float32)))
+        if len(lights) > Shader.max_lights:
+            if Shader.light_tiling:
+                Shader.upload_light_tiles(lights, bounds)
+                block.flush()
+                return
+            lights = Shader.nearest_lights(lights, bounds, Shader.max_lights)
+
+        block['num_lights'] = len(lights)
+        block['tiled'] = 0
+        Shader.light_tiles_key = None # the block no longer holds the tiles
+
+        # only lights which changed or moved to another index are written
+        uploaded = Shader.uploaded_lights
+        for i, light in enumerate(lights):
+            if i >= len(uploaded) or uploaded[i] is not light or light.slot in light.array.dirty:
+                block.set('lights', light.shader_data(), index=i)
+                light.array.dirty.discard(light.slot)
+        Shader.uploaded_lights = list(lights)
+        block.flush()
 
-        offset = 4*8
-        for light in lights:
-            Shader.ulight.upload((offset, 4*Shader.light_size, light.shader_data()))
-            offset += 4*Shader.light_size
+    @staticmethod
+    def nearest_lights(lights, bounds, count):
+        """ The count lights closest to the center of bounds """
+        if bounds is None:
+            return lights[:count]
+        pos = lights[0].array.data[[light.slot for light in lights]]
+        x, y = (bounds[0] + bounds[2]) * 0.5, (bounds[1] + bounds[3]) * 0.5
+        distance = (pos[:,0] - x) ** 2 + (pos[:,1] - y) ** 2
+        return [lights[i] for i in np.argsort(distance)[:count]]
 
     @staticmethod
-    def lightbuffer_size(num_lights):
-        return 4*4 + 4*Shader.light_size*num_lights
+    def upload_light_tiles(lights, bounds):
+        array = lights[0].array
+        key = (bounds, lights, array, array.version)
+        if key == Shader.light_tiles_key:
+            return
+
+        if bounds is None:
+            pos = array.data[[light.slot for light in lights]]
+            bounds = (pos[:,0].min(), pos[:,1].min(), pos[:,0].max(), pos[:,1].max())
+
+        records, cells, indices = Shader.light_buffers
+        if Shader.light_tiles_key is None or Shader.light_tiles_key[2:] != key[2:]:
+            records.upload(array.data[:len(array)])
+
+        size = Shader.light_tile_size
+        cols, rows, cell_data, index_data = light_tiles(lights, bounds, size)
+        cells.upload(cell_data)
+        indices.upload(index_data)
+
+        block = Shader.ulight
+        block['num_lights'] = len(lights)
+        block['tiled'] = 1
+        block['grid_rows'] = rows
+        block['light_grid'] = (bounds[0], bounds[1], size, cols)
+
+        for unit, buffer in zip(Shader.light_units, Shader.light_buffers):
+            buffer.bind(unit)
+        Shader.light_tiles_key = key
 
     @staticmethod
     def initialize():
         if Shader.uproj is not None: return
 
-        Shader.uproj = UniformBlock('projectionViewMatrices', 4*16*3)
-        Shader.umodel = UniformBlock('modelMatrices', 4*16*1)
-        Shader.ugame = UniformBlock('game', 4*5)
-        Shader.ulight = UniformBlock('light', Shader.lightbuffer_size(Shader.max_lights))
-
-        for i in range(2):
-            glEnableVertexAttribArray(i)
+        # same layout as the blocks in common.glsl
+        Shader.uproj = UniformBlock('projectionViewMatrices', [
+            ('projectionViewMatrix', 'mat4'),
+            ('projectionMatrix', 'mat4'),
+            ('viewMatrix', 'mat4'),
+        ])
+        Shader.umodel = UniformBlock('modelMatrices', [
+            ('modelMatrix', 'mat4'),
+            ('uvRect', 'vec4'),
+        ])
+        Shader.ugame = UniformBlock('game', [
+            ('player_pos', 'vec2'),
+            ('time', 'float'),
+            ('hp', 'float'),
+            ('fade', 'float'),
+        ])
+        Shader.ulight = UniformBlock('light', [
+            ('num_lights', 'uint'),
+            ('tiled', 'uint'),
+            ('grid_rows', 'uint'),
+            ('ambient', 'vec4'),
+            ('light_grid', 'vec4'),
+            ('lights', 'light_data', Shader.max_lights),
+        ])
+
+        # tiled lights: records, (first, count) per tile and record indices.
+        # GL 4.3 only guarantees 16 units for fragment shaders, without the
+        # light units the nearest max_lights are used instead.
+        Shader.light_buffers = (TBO(GL_RGBA32F), TBO(GL_RG32UI), TBO(GL_R32UI))
+        Shader.light_tiling = glGetIntegerv(GL_MAX_TEXTURE_IMAGE_UNITS) > max(Shader.light_units)
@@ -0,0 +1,40 @@
+from OpenGL.GL import *
+import numpy as np
+
+class TBO(object):
+    """ Buffer texture, a buffer read with texelFetch from a samplerBuffer """
+
+    def __init__(self, format, usage=GL_STREAM_DRAW):
+        self.buffer = glGenBuffers(1)
+        self.texture = glGenTextures(1)
+        self.format = format
+        self.usage = usage
+        self.size = 0
+
+        # the buffer needs storage before it can be attached
+        self.upload(np.zeros(4, np.uint32))
+        glBindTexture(GL_TEXTURE_BUFFER, self.texture)
+        glTexBuffer(GL_TEXTURE_BUFFER, format, self.buffer)
+        glBindTexture(GL_TEXTURE_BUFFER, 0)
+
+    def destroy(self):
+        if self.buffer is not None:
+            glDeleteTextures([self.texture])
+            glDeleteBuffers(1, [self.buffer])
+            self.buffer = None
+
+    def upload(self, data):
+        """ Replace the contents, the storage is reallocated when it grows """
+        data = np.ascontiguousarray(data)
+        glBindBuffer(GL_TEXTURE_BUFFER, self.buffer)
+        if data.nbytes > self.size:
+            self.size = max(data.nbytes, self.size * 2)
+            glBufferData(GL_TEXTURE_BUFFER, self.size, None, self.usage)
+        if data.nbytes > 0:
+            glBufferSubData(GL_TEXTURE_BUFFER, 0, data.nbytes, data)
+        glBindBuffer(GL_TEXTURE_BUFFER, 0)
+
+    def bind(self, unit):
+        glActiveTexture(GL_TEXTURE0 + unit)
+        glBindTexture(GL_TEXTURE_BUFFER, self.texture)
+        glActiveTexture(GL_TEXTURE0)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Cache of decoded textures. Each source image is stored as raw RGBA (and
+optionally its mip chain) in a single .npy which is memory-mapped on load,
+so the levels go to glTexImage2D without decoding or copying. Entries are
+invalidated by the source fingerprint (see utils.cache.fresh). """
+
+import os
+import thread
+import traceback
+import pygame
+import numpy as np
+import utils.cache as cache
+
+# bump when the layout of the cached textures changes
+compiled_version = 1
+
+def compiled_path(*parts):
+    return cache.path('texture', *parts)
+
+def entry_name(filename, mipmaps, premultiply):
+    name = filename.replace('/', '_').replace('\\', '_')
+    return name + (mipmaps and '.mip' or '') + (premultiply and '.pre' or '')
+
+def decode(filename):
+    """ Decode an image file (relative to data) as a (height, width, 4) RGBA array """
+    surface = pygame.image.load(os.path.join('data', filename))
+    w, h = surface.get_size()
+    return np.fromstring(pygame.image.tostring(surface, 'RGBA', 0), np.uint8).reshape(h, w, 4)
+
+def premultiplied(image):
+    rgb = image[:,:,:3].astype(np.uint16) * image[:,:,3:] // 255
+    return np.dstack((rgb.astype(np.uint8), image[:,:,3:]))
+
+def downsample(image):
+    """ Next mip level, average of each 2x2 block (odd edges are dropped) """
+    h, w = image.shape[:2]
+    fy, fx = h > 1 and 2 or 1, w > 1 and 2 or 1
+    h2, w2 = h // fy, w // fx
+    x = image[:h2 * fy, :w2 * fx].astype(np.uint16).reshape(h2, fy, w2, fx, 4)
+    n = fy * fx
+    return ((x.sum(axis=3).sum(axis=1) + n // 2) // n).astype(np.uint8)
+
+def mip_chain(image):
+    levels = [image]
+    while levels[-1].shape[0] > 1 or levels[-1].shape[1] > 1:
+        levels.append(downsample(levels[-1]))
+    return levels
+
+def compile_texture(filename, mipmaps=False, premultiply=False):
+    """ Decode filename and write it to the cache. Returns the same levels as
+    load. """
+    image = decode(filename)
+    if premultiply:
+        image = premultiplied(image)
+    levels = mipmaps and mip_chain(image) or [image]
+
+    meta = {
+        'version': compiled_version,
+        'source': cache.fingerprint(os.path.join('data', filename)),
+        'levels': [],
+    }
+    offset = 0
+    for level in levels:
+        meta['levels'].append((level.shape[1], level.shape[0], offset))
+        offset += level.nbytes
+
+    # a read-only install still works, it just decodes the image every time
+    try:
+        name = entry_name(filename, mipmaps, premultiply)
+        cache.makedirs(compiled_path())
+        tmp = compiled_path('%s.%d.%d.tmp.npy' % (name, os.getpid(), thread.get_ident()))
+        np.save(tmp, np.concatenate([level.reshape(-1) for level in levels]))
+        os.rename(tmp, compiled_path(name + '.npy'))
+        cache.write_json(compiled_path(name + '.json'), meta) # written last, marks the entry as complete
+    except (IOError, OSError):
+        traceback.print_exc()
+
+    return levels
+
+def load(filename, mipmaps=False, premultiply=False):
+    """ The (height, width, 4) RGBA levels of an image (only the first unless
+    mipmaps), memory-mapped from the cache. The cache entry is (re)built
+    if missing or stale. """
+    name = entry_name(filename, mipmaps, premultiply)
+    try:
+        meta = cache.read_json(compiled_path(name + '.json'))
+        source = dict(meta['source'])
+        if meta['version'] == compiled_version and cache.fresh(meta['source'], os.path.join('data', filename)):
+            data = np.load(compiled_path(name + '.npy'), mmap_mode='r')
+            cache.restamp(compiled_path(name + '.json'), meta, dict(meta, source=source))
+            return [data[offset:offset + w * h * 4].reshape(h, w, 4) for w, h, offset in meta['levels']]
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+
+    return compile_texture(filename, mipmaps, premultiply)
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import math
+import cairo, pango
+from OpenGL.GL import *
+import numpy as np
+from render.hud import Surface
+from render.vbo import VBO
+
+# rasterized up front, anything else on first use
+preload = u''.join(unichr(c) for c in range(32, 127))
+
+class Glyph(object):
+    """ Placement of a glyph (or a whole string, see GlyphAtlas.string) in
+    the atlas. Offsets are from the pen position to the top-left of the ink,
+    the pen is at the top of the line as with pango layouts. """
+
+    __slots__ = ('x', 'y', 'width', 'height', 'uv', 'advance')
+
+    def __init__(self, x, y, width, height, uv, advance):
+        self.x, self.y = x, y
+        self.width, self.height = width, height
+        self.uv = uv # (u0, v0, u1, v1)
+        self.advance = advance
+
+class GlyphAtlas(object):
+    """ Glyphs of a single pango.FontDescription rasterized once into a
+    texture, packed in shelves. Metrics and kerning are cached, kerning
+    pairs lazily. When the atlas fills up it is cleared and glyphs are
+    rasterized again on demand (check generation). """
+
+    padding = 1
+
+    def __init__(self, font, size=512):
+        self.font = font
+        self.size = size
+        self.surface = Surface(size, size)
+
+        # coverage only, colored when drawn
+        options = cairo.FontOptions()
+        options.set_antialias(cairo.ANTIALIAS_GRAY)
+        self.surface.cr.set_font_options(options)
+        self.layout = self.surface.layout
+        self.layout.set_font_description(font)
+
+        self.texture = glGenTextures(1)
+        glBindTexture(GL_TEXTURE_2D, self.texture)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, size, size, 0, GL_BGRA, GL_UNSIGNED_BYTE, self.surface.data)
+
+        self.generation = 0
+        self.reset()
+        for c in preload:
+            self.glyph(c)
+
+    def destroy(self):
+        if self.texture is not None:
+            glDeleteTextures([self.texture])
+            self.texture = None
+
+    def reset(self):
+        """ Throw away all glyphs """
+        self.glyphs = {}
+        self.strings = {}
+        self.kerning = {}
+        self.shelf = (0, 0, 0) # x, y and height of the current shelf
+        self.surface.clear((0,0,0,0))
+        self.generation += 1
+
+    def measure(self, text, markup=False):
+        """ (ink, logical) extents in pixels (floats) """
+        if markup:
+            self.layout.set_markup(text)
+        else:
+            # set_text keeps the attributes of the last markup
+            self.layout.set_attributes(pango.AttrList())
+            self.layout.set_text(text)
+        ink, logical = self.layout.get_extents()
+        s = float(pango.SCALE)
+        return tuple(v / s for v in ink), tuple(v / s for v in logical)
+
+    def allocate(self, w, h):
+        """ Find room for a w x h rectangle, returns (x, y) or None """
+        x, y, height = self.shelf
+        if x + w > self.size:
+            x, y, height = 0, y + height, 0
+        if w > self.size or y + h > self.size:
+            return None
+        self.shelf = (x + w, y, max(height, h))
+        return x, y
+
+    def rasterize(self, text, markup=False):
+        ink, logical = self.measure(text, markup)
+
+        # whole pixels around the ink, with a margin for antialiasing
+        ix, iy = int(math.floor(ink[0])) - 1, int(math.floor(ink[1])) - 1
+        iw = int(math.ceil(ink[0] + ink[2])) + 1 - ix
+        ih = int(math.ceil(ink[1] + ink[3])) + 1 - iy
+        if ink[2] <= 0 or ink[3] <= 0:
+            iw = ih = 0 # e.g. space
+
+        pad = self.padding
+        pos = self.allocate(iw + 2 * pad, ih + 2 * pad)
+        if pos is None:
+            return None
+        x, y = pos[0] + pad, pos[1] + pad
+
+        if iw > 0:
+            cr = self.surface.cr
+            cr.save()
+            cr.translate(x - ix, y - iy)
+            cr.set_source_rgba(1, 1, 1, 1)
+            self.surface.pango.show_layout(self.layout)
+            self.surface.touch(ix, iy, ix + iw, iy + ih)
+            cr.restore()
+
+        s = float(self.size)
+        uv = (x / s, y / s, (x + iw) / s, (y + ih) / s)
+        return Glyph(ix, iy, iw, ih, uv, logical[2])
+
+    def glyph(self, c):
+        """ Glyph of a single character, rasterized on first use """
+        glyph = self.glyphs.get(c)
+        if glyph is None:
+            glyph = self.rasterize(c)
+            if glyph is None:
+                self.reset()
+                glyph = self.rasterize(c)
+            self.glyphs[c] = glyph
+        return glyph
+
+    def string(self, text, markup=True):
+        """ A whole string rasterized by pango as a single glyph, for markup
+        and anything which needs real layout """
+        key = (text, markup)
+        glyph = self.strings.get(key)
+        if glyph is None:
+            glyph = self.rasterize(text, markup)
+            if glyph is None:
+                self.reset()
+                glyph = self.rasterize(text, markup)
+                if glyph is None:
+                    raise ValueError, 'String does not fit the glyph atlas: %r' % text
+            self.strings[key] = glyph
+        return glyph
+
+    def kern(self, a, b):
+        """ Adjustment of the advance between characters a and b """
+        key = a + b
+        k = self.kerning.get(key)
+        if k is None:
+            k = self.measure(key)[1][2] - self.glyph(a).advance - self.glyph(b).advance
+            self.kerning[key] = k
+        return k
+
+    def upload(self):
+        self.surface.surface.flush()
+        self.surface.upload(self.texture)
+
+def simple(text):
+    """ Tell if text can be drawn glyph by glyph: no markup and nothing which
+    needs shaping (combining marks, right to left, etc) """
+    if '<' in text or '&' in text or '\n' in text:
+        return False
+    return all(u' ' <= c <= u'\u024f' for c in unicode(text))
+
+class TextRenderer(object):
+    """ Draws strings from a GlyphAtlas as textured quads.
+
+    Strings are queued with text and drawn together by draw, as one dynamic
+    VBO in the pixel space of a HUD (y down, model matrix set by caller).
+    Strings which are not simple fall back to being rasterized whole by
+    pango (once, cached in the atlas). The quads are only rebuilt when the
+    queued strings differ from the previous draw. """
+
+    # position, uv and color (see data/shader/text.vs)
+    format = ((0, 3), (1, 2), (2, 4))
+    floats = 3 + 2 + 4
+
+    def __init__(self, atlas):
+        self.atlas = atlas
+        self.queue = []
+        self.key = None
+        self.vbo = VBO(GL_QUADS, np.zeros(4 * self.floats, np.float32), np.arange(4, dtype=np.uint32), self.format, GL_STREAM_DRAW)
+        self.num_indices = 0
+
+    def destroy(self):
+        self.vbo.destroy()
+
+    def text(self, text, x, y, color=(0,0,0,1)):
+        """ Queue text with the top-left of its line at (x, y) """
+        self.queue.append((text, x, y, tuple(color)))
+
+    def layout(self, text, x, y):
+        """ Glyphs of text and where they go, [(glyph, x, y)] """
+        atlas = self.atlas
+        if not simple(text):
+            return [(atlas.string(text), x, y)]
+
+        result = []
+        pen = float(x)
+        prev = None
+        for c in unicode(text):
+            if prev is not None:
+                pen += atlas.kern(prev, c)
+            glyph = atlas.glyph(c)
+            result.append((glyph, int(round(pen)), y))
+            pen += glyph.advance
+            prev = c
+        return result
+
+    def build(self):
+        quads = []
+        for text, x, y, color in self.queue:
+            for glyph, gx, gy in self.layout(text, x, y):
+                if glyph.width == 0:
+                    continue
+                x0, y0 = gx + glyph.x, gy + glyph.y
+                x1, y1 = x0 + glyph.width, y0 + glyph.height
+                u0, v0, u1, v1 = glyph.uv
+                quads.append((
+                    x0, y0, 0, u0, v0) + color + (
+                    x1, y0, 0, u1, v0) + color + (
+                    x1, y1, 0, u1, v1) + color + (
+                    x0, y1, 0, u0, v1) + color)
+        return quads
+
+    def draw(self):
+        """ Draw (and dequeue) the queued strings, the text shader must be bound """
+        atlas = self.atlas
+        key = (self.queue, atlas.generation)
+        if key != self.key:
+            quads = self.build()
+            if atlas.generation != key[1]:
+                quads = self.build() # the atlas was reset halfway, once more
+
+            vertices = np.array(quads, np.float32).reshape(-1)
+            indices = np.arange(4 * len(quads), dtype=np.uint32)
+            self.vbo.upload(vertices, indices)
+            self.num_indices = len(indices)
+            self.key = (self.queue, atlas.generation)
+
+        self.queue = []
+        atlas.upload()
+        if self.num_indices == 0:
+            return
+
+        glBindTexture(GL_TEXTURE_2D, atlas.texture)
+        self.vbo.draw(0, self.num_indices)
@@ -3,39 +3,102 @@ from OpenGL.GLU import *
 from ctypes import c_void_p
 import numpy as np
 
+# (location, components) of each interleaved float attribute: position and uv
+default_format = ((0, 3), (1, 2))
+
+# all VBOs which are not destroyed yet, see cleanup
+live = set()
+
+def setup_attributes(format, divisor=0):
+    """ Enable and point the attributes in format at the bound GL_ARRAY_BUFFER
+    (interleaved floats). Records into the bound vertex array. """
+    stride = 4 * sum(n for _, n in format)
+    offset = 0
+    for location, n in format:
+        glEnableVertexAttribArray(location)
+        glVertexAttribPointer(location, n, GL_FLOAT, GL_FALSE, stride, c_void_p(offset))
+        if divisor:
+            glVertexAttribDivisor(location, divisor)
+        offset += 4 * n
+
+def cleanup():
+    """ Destroy all remaining VBOs, call while the GL context still exists """
+    for vbo in list(live):
+        vbo.destroy()
+
 class VBO(object):
-    stride = 4*5
+    """ Vertex and index buffer with a vertex array object holding the
+    attribute layout, so drawing is a single bind. Call destroy (or
+    render.vbo.cleanup) to release it, GL objects cannot be safely deleted
+    from a finalizer. """
 
-    def __init__(self, what, vertices, indices):
+    def __init__(self, what, vertices, indices, format=default_format, usage=GL_STATIC_DRAW):
         self.buffer = glGenBuffers(2)
+        self.vao = glGenVertexArrays(1)
         self.what = what
+        self.format = format
+        self.usage = usage
         self.num_vertices = len(vertices)
         self.num_indices = len(indices)
 
         glBindBuffer(GL_ARRAY_BUFFER, self.buffer[0])
-        glBufferData(GL_ARRAY_BUFFER, 4 * len(vertices), vertices, GL_STATIC_DRAW)
-        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        glBufferData(GL_ARRAY_BUFFER, 4 * len(vertices), vertices, usage)
 
+        glBindVertexArray(self.vao)
         glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.buffer[1])
-        glBufferData(GL_ELEMENT_ARRAY_BUFFER, 4 * len(indices), indices, GL_STATIC_DRAW)
-        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, 0)
+        glBufferData(GL_ELEMENT_ARRAY_BUFFER, 4 * len(indices), indices, usage)
+        setup_attributes(format)
+        glBindVertexArray(0)
 
-    def __del__(self):
-        self.destroy()
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, 0)
+        live.add(self)
 
     def destroy(self):
         if self.buffer is not None:
+            glDeleteVertexArrays(1, [self.vao])
             glDeleteBuffers(2, self.buffer)
             self.buffer = None
+            self.vao = None
+        live.discard(self)
+
+    def upload(self, vertices, indices):
+        """ Replace the contents (e.g. for GL_STREAM_DRAW buffers), the old
+        storage is orphaned so this does not wait for pending draws """
+        self.num_vertices = len(vertices)
+        self.num_indices = len(indices)
 
-    def draw(self):
+        glBindBuffer(GL_ARRAY_BUFFER, self.buffer[0])
+        glBufferData(GL_ARRAY_BUFFER, 4 * len(vertices), vertices, self.usage)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+        glBindVertexArray(self.vao)
+        glBufferData(GL_ELEMENT_ARRAY_BUFFER, 4 * len(indices), indices, self.usage)
+        glBindVertexArray(0)
+
+    def bind(self):
+        glBindVertexArray(self.vao)
+
+    @staticmethod
+    def unbind():
+        glBindVertexArray(0)
+
+    def bind_buffers(self):
+        """ Bind the vertex and index buffer and their attributes into the
+        currently bound vertex array (for sharing them, e.g. SpriteBatch) """
         glBindBuffer(GL_ARRAY_BUFFER, self.buffer[0])
         glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.buffer[1])
+        setup_attributes(self.format)
 
-        glVertexAttribPointer(0, 3, GL_FLOAT, GL_FALSE, self.stride, c_void_p(0))
-        glVertexAttribPointer(1, 2, GL_FLOAT, GL_FALSE, self.stride, c_void_p(4*3))
+    def draw(self, first=0, count=None):
+        """ Draw all indices or only the range [first, first+count) """
+        if count is None:
+            count = self.num_indices - first
 
-        glDrawElements(self.what, self.num_indices, GL_UNSIGNED_INT, None)
+        glBindVertexArray(self.vao)
+        glDrawElements(self.what, count, GL_UNSIGNED_INT, c_void_p(4*first))
 
-        glBindBuffer(GL_ARRAY_BUFFER, 0)
-        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, 0)
+    def draw_instanced(self, instances, base_instance=0):
+        """ Draw all indices once per instance, a vertex array with this
+        buffer must be bound. Per instance attributes start at base_instance. """
+        glDrawElementsInstancedBaseInstance(self.what, self.num_indices, GL_UNSIGNED_INT, c_void_p(0), instances, base_instance)
@@ -0,0 +1,154 @@
+from utils.vector import Vector2f
+from map import Map
+from engine.aim import AimSolver
+import math
+import item
+import random
+
+class DummyProjectile(object):
+    def __init__(self, delay=None):
+        self.delay = delay
+
+    def __nonzero__(self):
+        return False
+
+    def update(self, map, dt):
+        # hack to force a small delay between missing target and next player get to fire
+        if self.delay is not None:
+            self.delay -= dt
+            if self.delay <= 0:
+                game.next_player()
+                self.delay = None
+
+    def draw(self):
+        pass
+
+class Simulation(object):
+    """ Game state and rules: map, items, projectiles, wind and turns. Needs no
+    display, GL context or pango, Game extends it with input and rendering. """
+
+    proj_spawn = [Vector2f(6, -10), Vector2f(125, -10)]
+    windmax = 1.0
+    headless = True
+    alpha = 1.0 # how far rendering is between the last two steps, see Game.run
+
+    def __init__(self, computer=()):
+        """ computer lists the players (0 or 1) controlled by the AimSolver """
+        self.sim_time = 0.0
+        self.computer = computer
+        self.solver = None
+
+    def load(self, filename):
+        self.map = Map(filename, headless=self.headless)
+        self.camera_max = self.map.width - 38
+        self.catapults = [self.map.get_named_item('Catapult 1'), self.map.get_named_item('Catapult 2')]
+        if self.computer:
+            self.solver = AimSolver(self)
+        self.reset()
+
+    def time(self):
+        """ Get current (simulated) time as float """
+        return self.sim_time
+
+    def reset(self):
+        self.projectile = DummyProjectile()
+        self.angle = [60, 60]
+        self.force = [150, 150]
+        self.player = 0
+        self.firing = False
+        self.miss = False
+        self.is_over = False
+        self.textbuf = []
+        self.catapults[0].set_loaded(True)
+        self.random_wind()
+
+    def over(self):
+        self.is_over = True
+
+    def random_wind(self):
+        r = float(random.randint(0, 10000)) / 10000 # [0..1]
+        r = r * 2.0 - 1.0 # [-1..1]
+        self.wind = r * self.windmax
+
+    def next_player(self):
+        self.player = 1 - self.player
+        self.firing = False
+        self.random_wind()
+
+    def can_fire(self):
+        return not self.firing
+
+    def computer_turn(self):
+        """ Aim and fire for a computer controlled player """
+        shot = self.solver.solve(self.player, self.wind)
+        if shot is not None:
+            self.angle[self.player], self.force[self.player] = shot[:2]
+        self.projectile_fire()
+
+    def projectile_fire(self):
+        if not self.firing:
+            self.firing = True
+
+            a = math.radians(self.angle[self.player])
+            f = self.force[self.player] * 5
+            force = Vector2f(math.cos(a), math.sin(a)) * f
+
+            if self.player == 1:
+                force.x *= -1
+
+            p = self.proj_spawn[self.player]
+            self.catapults[self.player].set_loaded(False)
+            self.projectile = item.create('projectile', name='projectile', x=p.x, y=p.y, flip=self.player==0)
+            if not self.headless:
+                self.projectile.attach_renderer()
+            self.projectile.impulse(force, 0.1)
+
+    def projectile_miss(self, projectile):
+        self.miss = True # defer so the projectile is rendered one more frame
+
+    def projectile_hit(self, hit):
+        # hack: remove all other message
+        self.textbuf = []
+
+        # hack: directly inject message
+        if self.player != hit:
+            self.text = 'Player %d hit the other player and won!' % (self.player+1)
+        else:
+            self.text = 'Player %d hit himself and lost...' % (self.player+1)
+        self.text += '\n\nPress ESC to restart.'
+
+        if hit == self.player:
+            self.catapults[self.player].set_broken()
+        else:
+            self.catapults[1-self.player].set_broken()
+
+        self.over()
+
+    def message(self, text):
+        self.textbuf.append(text)
+
+    def step(self, dt):
+        """ Advance the simulation by dt """
+        if self.is_over:
+            return
+
+        if self.miss:
+            self.message('Player %d missed the target' % (self.player+1,))
+            self.old_projectile = self.projectile
+            self.projectile = DummyProjectile(4)
+            self.miss = False
+
+        if self.player in self.computer and self.can_fire():
+            self.computer_turn()
+
+        self.map.update()
+        self.projectile.update(self.map, dt)
+        self.sim_time += dt
+
+def headless(filename='map.json', computer=()):
+    """ Create a simulation without display or GL context. It is installed as
+    the `game` superglobal since items expect it. """
+    sim = Simulation(computer)
+    __builtins__['game'] = sim
+    sim.load(filename)
+    return sim
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Projectile simulation benchmark, steps N projectiles one at a time through
+PhysicsItem and all at once through engine.projectiles.ProjectileBatch.
+
+Run with "python -m tools.bench_projectiles" from the project root.
+"""
+
+import math
+import time
+import numpy as np
+import simulation
+from engine.projectiles import ProjectileBatch
+
+def shots(n, seed=1):
+    """ Random (angle, force) pairs from player 1, same units as Game.angle/force """
+    rng = np.random.RandomState(seed)
+    return zip(rng.uniform(0, 90, n).tolist(), rng.uniform(0, 1500, n).tolist())
+
+def spawn_force(angle, force):
+    a = math.radians(angle)
+    return math.cos(a) * force * 5, math.sin(a) * force * 5
+
+def run_items(sim, shots, dt=0.05, max_steps=4000):
+    steps = 0
+    for angle, force in shots:
+        sim.player = 0
+        sim.angle[0], sim.force[0] = angle, force
+        sim.firing = sim.miss = False
+        sim.projectile_fire()
+        for i in xrange(max_steps):
+            if sim.miss: break
+            sim.projectile.update(sim.map, dt)
+            steps += 1
+    return steps
+
+def run_batch(sim, shots, dt=0.05, max_steps=4000):
+    batch = ProjectileBatch(sim.map, len(shots), sim.camera_max + 32)
+    batch.spawn([sim.proj_spawn[0].xy] * len(shots), [spawn_force(a, f) for a, f in shots])
+    while batch.any_alive() and batch.steps < max_steps:
+        batch.step(dt, sim.wind)
+    return batch.steps
+
+def measure(func, *args):
+    begin = time.time()
+    func(*args)
+    return time.time() - begin
+
+def main(sizes):
+    sim = simulation.headless()
+    sim.wind = 0.3
+
+    print '%10s %12s %12s %8s' % ('shots', 'items [s]', 'batch [s]', 'speedup')
+    for n in sizes:
+        s = shots(n)
+        old = measure(run_items, sim, s)
+        new = measure(run_batch, sim, s)
+        print '%10d %12.4f %12.4f %7.1fx' % (n, old, new, old / new)
+
+if __name__ == '__main__':
+    main([10, 100, 1000])
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tile layer mesh build benchmark, compares the vectorized engine.map.tile_mesh
+with the old per-tile python loop on synthetic maps.
+
+Run with "python -m tools.bench_tiles" from the project root.
+"""
+
+import sys
+import time
+import numpy as np
+from engine.map import tile_mesh
+
+def legacy_tile_mesh(data, width, tile_width, tile_height):
+    """ The original Map.load_tiles loop (including empty tiles) """
+    dx = tile_width  / 128.0
+    dy = tile_height / 128.0
+    tile_div = 128 / tile_width
+
+    n = len(data)
+    ver = np.zeros((n*4, 5), np.float32)
+    for i, tile in enumerate(data):
+        x = i % width
+        y = -(i / width)
+
+        tile -= 1 # start with 0 index
+        tx = tile % tile_div
+        ty = tile / tile_div
+
+        ver[i*4+0] = (x  , y  , 0, tx*dx,    ty*dy+dy)
+        ver[i*4+1] = (x+1, y  , 0, tx*dx+dx, ty*dy+dy)
+        ver[i*4+2] = (x+1, y+1, 0, tx*dx+dx, ty*dy)
+        ver[i*4+3] = (x  , y+1, 0, tx*dx,    ty*dy)
+
+    ver = ver.flatten()
+    ind = np.array(range(n*4), np.uint32)
+    return ver, ind
+
+def synthetic(width, height, fill=0.6, seed=1):
+    """ Random tile layer where roughly `fill` of the tiles are non-empty """
+    rng = np.random.RandomState(seed)
+    grid = rng.randint(1, 256, size=width*height).astype(np.uint32)
+    grid[rng.random_sample(width*height) > fill] = 0
+    return grid
+
+def measure(func, *args):
+    begin = time.time()
+    func(*args)
+    return time.time() - begin
+
+def main(sizes, legacy_limit=1000000):
+    print '%10s %12s %12s %8s' % ('tiles', 'legacy [s]', 'numpy [s]', 'speedup')
+    for width, height in sizes:
+        grid = synthetic(width, height)
+        n = width * height
+
+        new = measure(tile_mesh, grid, width, 8, 8)
+
+        # the python loop takes minutes on the largest maps
+        if n <= legacy_limit:
+            old = measure(legacy_tile_mesh, grid.tolist(), width, 8, 8)
+            print '%10d %12.4f %12.4f %7.1fx' % (n, old, new, old / new)
+        else:
+            print '%10d %12s %12.4f %8s' % (n, '-', new, '-')
+
+if __name__ == '__main__':
+    sizes = [(100, 100), (400, 250), (1000, 1000), (2000, 2000)]
+    main(sizes, legacy_limit='--all' in sys.argv and sys.maxint or 1000000)
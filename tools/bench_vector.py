@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Vector micro-benchmark, per operation cost and memory per instance of
+utils.vector.Vector2f compared with the old dict based old-style class.
+
+Run with "python -m tools.bench_vector" from the project root.
+"""
+
+import sys
+import timeit
+from utils.vector import Vector2f
+
+class LegacyVector2:
+    """ The original Vector2 (old-style class with a per-instance dict) """
+    datatype = float
+
+    def __init__(self, x=0.0, y=0.0):
+        if isinstance(x, tuple):
+            self.x, self.y = x
+        else:
+            self.x = self.__class__.datatype(x)
+            self.y = self.__class__.datatype(y)
+
+    def __add__(self, rhs):
+        return self.__class__(self.x + rhs.x, self.y + rhs.y)
+
+    def __sub__(self, rhs):
+        return self.__class__(self.x - rhs.x, self.y - rhs.y)
+
+    def __mul__(self, rhs):
+        try:
+            return self.__class__(self.x * rhs[0], self.y * rhs[1])
+        except TypeError:
+            return self.__class__(self.x * rhs, self.y * rhs)
+
+    def length_squared(self):
+        return self.x*self.x + self.y*self.y
+
+    def __getitem__(self, index):
+        return [self.x, self.y][index]
+
+    def __getattr__(self, key):
+        if key == 'xy': return (getattr(self, 'x'), getattr(self, 'y'))
+        try:
+            return self.__dict__[key]
+        except:
+            raise AttributeError, '%s has no attribute %s' % (self.__class__.__name__, key)
+
+# (name, statement) with a and b being vectors
+ops = [
+    ('construct', 'V(1.0, 2.0)'),
+    ('add', 'a + b'),
+    ('sub', 'a - b'),
+    ('mul scalar', 'a * 0.5'),
+    ('mul vector', 'a * b'),
+    ('length_squared', 'a.length_squared()'),
+    ('xy', 'a.xy'),
+    ('update', 'a + b * 0.05'), # as in PhysicsItem.update
+]
+
+def instance_size(v):
+    """ Bytes used by a vector, including its dict and the two floats """
+    size = sys.getsizeof(v) + sys.getsizeof(v.x) + sys.getsizeof(v.y)
+    if hasattr(v, '__dict__'):
+        size += sys.getsizeof(v.__dict__)
+    return size
+
+def measure(cls, stmt, number):
+    setup = 'from %s import %s as V; a = V(1.0, 2.0); b = V(3.0, 4.0)' % (cls.__module__, cls.__name__)
+    return min(timeit.Timer(stmt, setup).repeat(3, number)) / number
+
+def main(number=200000):
+    print '%16s %12s %12s %8s' % ('op', 'legacy [ns]', 'slots [ns]', 'speedup')
+    for name, stmt in ops:
+        old = measure(LegacyVector2, stmt, number) * 1e9
+        new = measure(Vector2f, stmt, number) * 1e9
+        print '%16s %12.1f %12.1f %7.2fx' % (name, old, new, old / new)
+
+    old = instance_size(LegacyVector2(1.0, 2.0))
+    new = instance_size(Vector2f(1.0, 2.0))
+    print '%16s %12d %12d %7.2fx' % ('bytes/instance', old, new, float(old) / new)
+
+if __name__ == '__main__':
+    main()
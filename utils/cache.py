@@ -0,0 +1,80 @@
+import os
+import json
+import errno
+import hashlib
+import thread
+
+# all compiled/derived data goes here, safe to remove at any time
+cache_dir = os.path.join('data', 'cache')
+
+def path(*parts):
+    return os.path.join(cache_dir, *parts)
+
+def makedirs(dirname):
+    try:
+        os.makedirs(dirname)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+def file_hash(filename):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as fp:
+        for block in iter(lambda: fp.read(1 << 16), ''):
+            h.update(block)
+    return h.hexdigest()
+
+def fingerprint(filename):
+    """ Identify the current version of a source file """
+    st = os.stat(filename)
+    return {
+        'hash': file_hash(filename),
+        'mtime': st.st_mtime,
+        'size': st.st_size,
+    }
+
+def fresh(stored, filename):
+    """ Tell if a stored fingerprint still matches the source file. mtime and
+    size is compared first so the file only has to be hashed when it has been
+    touched. If only the hash matches stored gets the new mtime and size, the
+    caller should write it back (see restamp) or it is hashed every time. """
+    if stored is None:
+        return False
+
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return False
+
+    if stored['mtime'] == st.st_mtime and stored['size'] == st.st_size:
+        return True
+
+    if stored['hash'] != file_hash(filename):
+        return False
+
+    stored['mtime'] = st.st_mtime
+    stored['size'] = st.st_size
+    return True
+
+def read_json(filename):
+    with open(filename) as fp:
+        return json.load(fp)
+
+def write_json(filename, data):
+    """ Write json atomically so a concurrent or aborted writer never leaves a
+    half written file behind """
+    makedirs(os.path.dirname(filename))
+    tmp = '%s.%d.%d.tmp' % (filename, os.getpid(), thread.get_ident())
+    with open(tmp, 'w') as fp:
+        json.dump(data, fp)
+    os.rename(tmp, filename)
+
+def restamp(filename, data, old):
+    """ Rewrite json data if fresh updated a fingerprint in it (it differs
+    from old). Failing to is fine, the source is just hashed again. """
+    if data == old:
+        return
+    try:
+        write_json(filename, data)
+    except (IOError, OSError):
+        pass
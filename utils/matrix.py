@@ -1,63 +1,197 @@
-from OpenGL.GL import *
-from OpenGL.GLU import *
+import numpy as np
 import math
 
+# Matrices are built directly in numpy with the same memory layout as
+# glGetFloatv(GL_MODELVIEW_MATRIX) returned, i.e. column-major as seen by GL
+# (translation in row 3). No GL context is required.
+#
+# Every function takes an optional `out` buffer (4x4 float32) which is
+# overwritten and returned instead of allocating a new matrix.
+
+_identity = np.identity(4, np.float32)
+
+def _result(out):
+    if out is None:
+        return _identity.copy()
+    out[...] = _identity
+    return out
+
+def identity(out=None):
+    return _result(out)
+
+def translate(x, y, z=0, out=None):
+    tr = _result(out)
+    tr[3,0] = x
+    tr[3,1] = y
+    tr[3,2] = z
+    return tr
+
+def scale(x, y, z=1, out=None):
+    tr = _result(out)
+    tr[0,0] = x
+    tr[1,1] = y
+    tr[2,2] = z
+    return tr
+
+def rotatez(angle, out=None):
+    tr = _result(out)
+    c = math.cos(angle)
+    s = math.sin(angle)
+    tr[0,0] =  c
+    tr[1,0] = -s
+    tr[0,1] =  s
+    tr[1,1] =  c
+    return tr
+
+def transform(tx, ty, tz, sx, sy, sz, out=None):
+    tr = _result(out)
+    tr[3,0] = tx
+    tr[3,1] = ty
+    tr[3,2] = tz
+    tr[0,0] = sx
+    tr[1,1] = sy
+    tr[2,2] = sz
+    return tr
+
+def perspective(fov, size, near, far, out=None):
+    """ Same as gluPerspective """
+    tr = _result(out)
+    f = 1.0 / math.tan(math.radians(fov) / 2.0)
+    tr[0,0] = f / size.ratio()
+    tr[1,1] = f
+    tr[2,2] = (far + near) / (near - far)
+    tr[2,3] = -1.0
+    tr[3,2] = (2.0 * far * near) / (near - far)
+    tr[3,3] = 0.0
+    return tr
+
+def ortho(resolution, out=None):
+    """ Same as gluOrtho2D(0, width, 0, height) """
+    tr = _result(out)
+    tr[0,0] = 2.0 / resolution.x
+    tr[1,1] = 2.0 / resolution.y
+    tr[2,2] = -1.0
+    tr[3,0] = -1.0
+    tr[3,1] = -1.0
+    return tr
+
+def lookat(ex, ey, ez, cx, cy, cz, ux, uy, uz, out=None):
+    """ Same as gluLookAt """
+    eye = np.array((ex, ey, ez), np.float64)
+    f = np.array((cx, cy, cz), np.float64) - eye
+    f /= np.linalg.norm(f)
+    s = np.cross(f, (ux, uy, uz))
+    s /= np.linalg.norm(s)
+    u = np.cross(s, f)
+
+    tr = _result(out)
+    tr[0:3,0] = s
+    tr[0:3,1] = u
+    tr[0:3,2] = -f
+    tr[3,0] = -np.dot(s, eye)
+    tr[3,1] = -np.dot(u, eye)
+    tr[3,2] =  np.dot(f, eye)
+    return tr
+
+def multiply(a, b, out=None):
+    """ Matrix product a*b, same as np.dot but can reuse an output buffer """
+    return np.dot(a, b, out=out)
+
 class Matrix:
-    @staticmethod
-    def perspective(fov, size, near, far):
-        glLoadIdentity()
-        gluPerspective(fov, size.ratio(), near, far)
-        return glGetFloatv(GL_MODELVIEW_MATRIX)
-
-    @staticmethod
-    def ortho(resolution):
-        glLoadIdentity()
-        gluOrtho2D(0.0, resolution.x, 0.0, resolution.y)
-        return glGetFloatv(GL_MODELVIEW_MATRIX)
-
-    @staticmethod
-    def lookat(ex, ey, ez, cx, cy, cz, ux, uy, uz):
-        glLoadIdentity()
-        gluLookAt(ex, ey, ez, cx, cy, cz, ux, uy, uz)
-        return glGetFloatv(GL_MODELVIEW_MATRIX)
-
-    @staticmethod
-    def identity():
-        glLoadIdentity()
-        return glGetFloatv(GL_MODELVIEW_MATRIX)
-
-    @staticmethod
-    def translate(x, y, z=0):
-        tr = Matrix.identity()
-        tr[3,0] = x
-        tr[3,1] = y
-        tr[3,2] = z
-        return tr
-
-    @staticmethod
-    def scale(x, y, z=1):
-        tr = Matrix.identity()
-        tr[0,0] = x
-        tr[1,1] = y
-        tr[2,2] = z
-        return tr
-
-    @staticmethod
-    def rotatez(angle):
-        tr = Matrix.identity()
-        tr[0,0] =  math.cos(angle)
-        tr[1,0] = -math.sin(angle)
-        tr[0,1] =  math.sin(angle)
-        tr[1,1] =  math.cos(angle)
-        return tr
-
-    @staticmethod
-    def transform(tx, ty, tz, sx, sy, sz):
-        tr = Matrix.identity()
-        tr[3,0] = tx
-        tr[3,1] = ty
-        tr[3,2] = tz
-        tr[0,0] = sx
-        tr[1,1] = sy
-        tr[2,2] = sz
-        return tr
+    """ Compatibility wrapper, same interface as the old GL/GLU based class """
+    perspective = staticmethod(perspective)
+    ortho = staticmethod(ortho)
+    lookat = staticmethod(lookat)
+    identity = staticmethod(identity)
+    translate = staticmethod(translate)
+    scale = staticmethod(scale)
+    rotatez = staticmethod(rotatez)
+    transform = staticmethod(transform)
+    multiply = staticmethod(multiply)
+
+# ------------------------------------------------------------------------------
+#
+# Unittesting
+#
+
+if __name__ == '__main__':
+    import unittest
+
+    class size(object):
+        def __init__(self, x, y):
+            self.x, self.y = x, y
+        def ratio(self):
+            return float(self.x) / self.y
+
+    class test_matrix(unittest.TestCase):
+        def assertMatrix(self, a, b):
+            self.assertEqual(a.dtype, np.float32)
+            self.assertEqual(a.shape, (4,4))
+            self.assertTrue(np.allclose(a, np.array(b, np.float32).T, atol=1e-6), '\n%s\n!=\n%s' % (a, np.array(b).T))
+
+        def test_identity(self):
+            self.assertMatrix(Matrix.identity(), np.identity(4))
+
+        def test_translate(self):
+            self.assertMatrix(Matrix.translate(1, 2, 3), [
+                    [1,0,0,1],
+                    [0,1,0,2],
+                    [0,0,1,3],
+                    [0,0,0,1]])
+
+        def test_scale(self):
+            self.assertMatrix(Matrix.scale(2, 3), np.diag([2,3,1,1]))
+
+        def test_rotatez(self):
+            c, s = math.cos(0.5), math.sin(0.5)
+            self.assertMatrix(Matrix.rotatez(0.5), [
+                    [c,-s,0,0],
+                    [s, c,0,0],
+                    [0, 0,1,0],
+                    [0, 0,0,1]])
+
+        def test_transform(self):
+            self.assertMatrix(Matrix.transform(1, 2, 3, 4, 5, 6), [
+                    [4,0,0,1],
+                    [0,5,0,2],
+                    [0,0,6,3],
+                    [0,0,0,1]])
+
+        def test_perspective(self):
+            f = 1.0 / math.tan(math.radians(37.5))
+            n, r = 0.1, 100.0
+            self.assertMatrix(Matrix.perspective(75, size(800, 600), n, r), [
+                    [f*0.75,0,0,0],
+                    [0,f,0,0],
+                    [0,0,(r+n)/(n-r),2*r*n/(n-r)],
+                    [0,0,-1,0]])
+
+        def test_ortho(self):
+            self.assertMatrix(Matrix.ortho(size(800, 600)), [
+                    [2/800.,0,0,-1],
+                    [0,2/600.,0,-1],
+                    [0,0,-1,0],
+                    [0,0,0,1]])
+
+        def test_lookat(self):
+            self.assertMatrix(Matrix.lookat(5,3,15, 5,3,0, 0,1,0), [
+                    [1,0,0,-5],
+                    [0,1,0,-3],
+                    [0,0,1,-15],
+                    [0,0,0,1]])
+
+        def test_out(self):
+            buf = np.zeros((4,4), np.float32)
+            m = Matrix.translate(1, 2, out=buf)
+            self.assertTrue(m is buf)
+            Matrix.scale(2, 2, out=buf)
+            self.assertEqual(buf[3,0], 0.0)
+            self.assertEqual(buf[0,0], 2.0)
+
+        def test_fresh(self):
+            a = Matrix.identity()
+            a[0,0] = 5
+            self.assertEqual(Matrix.identity()[0,0], 1.0)
+
+    suite = unittest.TestLoader().loadTestsFromTestCase(test_matrix)
+    unittest.TextTestRunner(verbosity=2).run(suite)
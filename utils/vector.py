@@ -2,9 +2,26 @@
 # -*- coding: utf-8 -*-
 
 import math
+import numbers
 import unittest
-
-class Vector2:
+import numpy as np
+
+# tell scalars from vectors without try/except, the common types are checked
+# first since isinstance against numbers.Number (e.g. numpy scalars) is slow
+_scalar = (float, int, long)
+_sequence = (tuple, list)
+
+def is_scalar(x):
+    if x.__class__ in _scalar:
+        return True
+    if x.__class__ in _sequence or isinstance(x, (Vector2, Vector3)):
+        return False
+    return isinstance(x, numbers.Number)
+
+class Vector2(object):
+    """ 2D vector. Instances only hold x and y (no per-instance dict) and
+    operators create the result with _make, skipping the constructor checks. """
+    __slots__ = ('x', 'y')
     datatype = float
 
     def __init__(self, x=0.0, y=0.0):
@@ -18,33 +35,56 @@ class Vector2:
             if len(x) == 2: # xy
                 self.x, self.y = x
         else:
-            self.x = self.__class__.datatype(x)
-            self.y = self.__class__.datatype(y)
+            self.x = self.datatype(x)
+            self.y = self.datatype(y)
+
+    @classmethod
+    def _make(cls, x, y):
+        """ Create a vector from components already of the right type """
+        v = object.__new__(cls)
+        v.x = x
+        v.y = y
+        return v
 
     def copy(self):
-        return self.__class__(self.x, self.y)
+        return self._make(self.x, self.y)
 
     def __add__(self, rhs):
-        return self.__class__(self.x + rhs.x, self.y + rhs.y)
+        return self._make(self.x + rhs.x, self.y + rhs.y)
 
     def __sub__(self, rhs):
-        return self.__class__(self.x - rhs.x, self.y - rhs.y)
+        return self._make(self.x - rhs.x, self.y - rhs.y)
 
     def __mul__(self, rhs):
-        try:
+        if is_scalar(rhs):
+            return self._make(self.x * rhs, self.y * rhs)
+        else:
             # componentwise multiplication
-            return self.__class__(self.x * rhs[0], self.y * rhs[1])
-        except TypeError:
-            # scalar multiplication
-            return self.__class__(self.x * rhs, self.y * rhs)
+            return self._make(self.x * rhs[0], self.y * rhs[1])
 
     def __div__(self, rhs):
-        try:
+        if is_scalar(rhs):
+            return self._make(self.x / rhs, self.y / rhs)
+        else:
             # componentwise division
-            return self.__class__(self.x / rhs[0], self.y / rhs[1])
-        except TypeError:
-            # scalar division
-            return self.__class__(self.x / rhs, self.y / rhs)
+            return self._make(self.x / rhs[0], self.y / rhs[1])
+
+    def iadd(self, rhs):
+        """ In-place add, returns self. Unlike += it changes the vector for
+        everyone holding a reference to it. """
+        self.x += rhs.x
+        self.y += rhs.y
+        return self
+
+    def imul(self, rhs):
+        """ In-place (scalar or componentwise) multiplication, returns self """
+        if is_scalar(rhs):
+            self.x *= rhs
+            self.y *= rhs
+        else:
+            self.x *= rhs[0]
+            self.y *= rhs[1]
+        return self
 
     def __repr__(self):
         return '<vector (%.3f, %.3f)>' % (self.x, self.y)
@@ -53,48 +93,74 @@ class Vector2:
         return self.x*self.x + self.y*self.y
 
     def length(self):
-        return math.sqrt(self.length_squared())
+        return math.sqrt(self.x*self.x + self.y*self.y)
 
     def normalize(self):
         len = self.length()
-        return self.__class__(float(self.x) / len, float(self.y) / len)
+        return self._make(float(self.x) / len, float(self.y) / len)
 
     def ratio(self):
         return float(self.x) / float(self.y)
 
     def __iter__(self):
-        return [self.x, self.y].__iter__()
+        return iter((self.x, self.y))
 
     def __getitem__(self, index):
-        return [self.x, self.y][index]
-
-    def __getattr__(self, key):
-        if key == 'width':  return getattr(self, 'x')
-        if key == 'height': return getattr(self, 'y')
+        return (self.x, self.y)[index]
 
-        # swizzle
-        if key == 'xy': return (getattr(self, 'x'), getattr(self, 'y'))
+    width  = property(lambda self: self.x)
+    height = property(lambda self: self.y)
 
-        try:
-            return self.__dict__[key]
-        except:
-            raise AttributeError, '%s has no attribute %s' % (self.__class__.__name__, key)
+    # swizzle
+    xy = property(lambda self: (self.x, self.y))
 
 class Vector2f (Vector2):
     """ Alias for Vector2, just for consistency """
-    pass
+    __slots__ = ()
 
 class Vector2i (Vector2):
     """ Vector2 with integer """
+    __slots__ = ()
     datatype = int
 
+    @classmethod
+    def _make(cls, x, y):
+        v = object.__new__(cls)
+        v.x = int(x)
+        v.y = int(y)
+        return v
+
     def __repr__(self):
         return '<vector (%d, %d)>' % self.xy
 
 def lerp2(a, b, s):
     return a + (b - a) * s
 
-class Vector3:
+def segment_distance(p, a, b):
+    """ Distance from point p to the line segment a-b """
+    ab = b - a
+    l = ab.length_squared()
+    if l == 0.0:
+        return (p - a).length()
+    s = min(max(((p.x - a.x) * ab.x + (p.y - a.y) * ab.y) / l, 0.0), 1.0)
+    return (p - lerp2(a, b, s)).length()
+
+def segment_distance_many(p, a, b):
+    """ Distance from point p (x, y) to each segment a-b, a and b are (2, n)
+    arrays (same as segment_distance) """
+    ab = b - a
+    ap = np.array(p, np.float32)[:,np.newaxis] - a
+    l = (ab * ab).sum(axis=0)
+    s = (ap * ab).sum(axis=0) / np.maximum(l, 1e-12)
+    np.clip(s, 0.0, 1.0, out=s)
+    ap -= ab * s
+    return np.sqrt((ap * ap).sum(axis=0))
+
+class Vector3(object):
+    """ 3D vector, same layout and conventions as Vector2 """
+    __slots__ = ('x', 'y', 'z')
+    datatype = float
+
     def __init__(self, x=0.0, y=0.0, z=0.0):
         if isinstance(x, tuple):
             if y != 0.0 or z != 0.0:
@@ -109,26 +175,49 @@ class Vector3:
             if len(x) == 3: # xyz
                 self.x, self.y, self.z = x
         else:
-            self.x = float(x)
-            self.y = float(y)
-            self.z = float(z)
+            self.x = self.datatype(x)
+            self.y = self.datatype(y)
+            self.z = self.datatype(z)
+
+    @classmethod
+    def _make(cls, x, y, z):
+        """ Create a vector from components already of the right type """
+        v = object.__new__(cls)
+        v.x = x
+        v.y = y
+        v.z = z
+        return v
 
     def copy(self):
-        return self.__class__(self.x, self.y, self.z)
+        return self._make(self.x, self.y, self.z)
 
     def __add__(self, rhs):
-        return self.__class__(self.x + rhs.x, self.y + rhs.y, self.z+rhs.z)
+        return self._make(self.x + rhs.x, self.y + rhs.y, self.z+rhs.z)
 
     def __sub__(self, rhs):
-        return self.__class__(self.x - rhs.x, self.y - rhs.y, self.z-rhs.z)
+        return self._make(self.x - rhs.x, self.y - rhs.y, self.z-rhs.z)
 
     # scalar multiplication
     def __mul__(self, scalar):
-        return self.__class__(self.x * scalar, self.y * scalar, self.z * scalar)
+        return self._make(self.x * scalar, self.y * scalar, self.z * scalar)
 
     # scalar division
     def __div__(self, scalar):
-        return self.__class__(self.x / scalar, self.y / scalar, self.z / scalar)
+        return self._make(self.x / scalar, self.y / scalar, self.z / scalar)
+
+    def iadd(self, rhs):
+        """ In-place add, returns self """
+        self.x += rhs.x
+        self.y += rhs.y
+        self.z += rhs.z
+        return self
+
+    def imul(self, scalar):
+        """ In-place scalar multiplication, returns self """
+        self.x *= scalar
+        self.y *= scalar
+        self.z *= scalar
+        return self
 
     def __repr__(self):
         return '<vector (%.3f, %.3f, %.3f)>' % (self.x, self.y, self.z)
@@ -137,41 +226,196 @@ class Vector3:
         return self.x*self.x + self.y*self.y + self.z*self.z
 
     def length(self):
-        return math.sqrt(self.length_squared())
+        return math.sqrt(self.x*self.x + self.y*self.y + self.z*self.z)
 
     def normalize(self):
         len = self.length()
-        return self.__class__(self.x / len, self.y / len, self.z / len)
+        return self._make(self.x / len, self.y / len, self.z / len)
 
     def __iter__(self):
-        return [self.x, self.y, self.z].__iter__()
+        return iter((self.x, self.y, self.z))
 
     def __getitem__(self, index):
-        return [self.x, self.y, self.z][index]
-
-    def __getattr__(self, key):
-        # swizzle
-        if key == 'xy':  return (getattr(self, 'x'), getattr(self, 'y'))
-        if key == 'xz':  return (getattr(self, 'x'), getattr(self, 'z'))
-        if key == 'yz':  return (getattr(self, 'y'), getattr(self, 'z'))
-        if key == 'xyz': return (getattr(self, 'x'), getattr(self, 'y'), getattr(self, 'z'))
+        return (self.x, self.y, self.z)[index]
 
-        try:
-            return self.__dict__[key]
-        except:
-            raise AttributeError, '%s has no attribute %s' % (self.__class__.__name__, key)
+    # swizzle
+    xy  = property(lambda self: (self.x, self.y))
+    xz  = property(lambda self: (self.x, self.z))
+    yz  = property(lambda self: (self.y, self.z))
+    xyz = property(lambda self: (self.x, self.y, self.z))
 
 class Vector3f (Vector3):
     """ Alias for Vector3, just for consistency """
-    pass
+    __slots__ = ()
 
 class Vector3i (Vector3):
     """ Vector3 with integer """
+    __slots__ = ()
     datatype = int
 
+    @classmethod
+    def _make(cls, x, y, z):
+        v = object.__new__(cls)
+        v.x = int(x)
+        v.y = int(y)
+        v.z = int(z)
+        return v
+
     def __repr__(self):
         return '<vector (%d, %d, %d)>' % self.xyz
 
+class Vector2View (Vector2f):
+    """ Vector2f reading and writing one row of a Vector2Array (no copy).
+    Results of operators are plain Vector2f. """
+    __slots__ = ('_row',)
+
+    def __init__(self, row):
+        self._row = row
+
+    @classmethod
+    def _make(cls, x, y):
+        return Vector2f._make(x, y)
+
+    def _set(i):
+        def setter(self, value):
+            self._row[i] = value
+        return setter
+
+    x = property(lambda self: float(self._row[0]), _set(0))
+    y = property(lambda self: float(self._row[1]), _set(1))
+    del _set
+
+class Vector3View (Vector3f):
+    """ Vector3f reading and writing one row of a Vector3Array (no copy) """
+    __slots__ = ('_row',)
+
+    def __init__(self, row):
+        self._row = row
+
+    @classmethod
+    def _make(cls, x, y, z):
+        return Vector3f._make(x, y, z)
+
+    def _set(i):
+        def setter(self, value):
+            self._row[i] = value
+        return setter
+
+    x = property(lambda self: float(self._row[0]), _set(0))
+    y = property(lambda self: float(self._row[1]), _set(1))
+    z = property(lambda self: float(self._row[2]), _set(2))
+    del _set
+
+class VectorArray(object):
+    """ N vectors stored in a (N, dim) float32 array. Operations work on all
+    vectors at once and return a new array (or a numpy array for scalars per
+    vector). Indexing with an int gives a view which behaves like a vector,
+    slices give an array sharing the same buffer. """
+    dim = None
+    view = None
+
+    def __init__(self, data=0):
+        """ data is a count (zero filled), an existing array (shared if it
+        already is (N, dim) float32) or a sequence of vectors or tuples """
+        if isinstance(data, (int, long)):
+            data = np.zeros((data, self.dim), np.float32)
+        elif not isinstance(data, np.ndarray):
+            data = np.array([tuple(v) for v in data], np.float32)
+        self.data = np.asarray(data, np.float32).reshape(-1, self.dim)
+
+    @classmethod
+    def _operand(cls, rhs):
+        """ Array (N, dim) or (dim,) to broadcast against data """
+        if isinstance(rhs, VectorArray):
+            return rhs.data
+        if isinstance(rhs, (Vector2, Vector3)):
+            return np.array(tuple(rhs), np.float32)
+        return np.asarray(rhs, np.float32)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, long)):
+            return self.view(self.data[index])
+        return self.__class__(self.data[index])
+
+    def __setitem__(self, index, value):
+        self.data[index] = self._operand(value)
+
+    def __iter__(self):
+        for row in self.data:
+            yield self.view(row)
+
+    def __repr__(self):
+        return '<%s %d>' % (self.__class__.__name__, len(self.data))
+
+    def copy(self):
+        return self.__class__(self.data.copy())
+
+    def add(self, rhs):
+        return self.__class__(self.data + self._operand(rhs))
+
+    def sub(self, rhs):
+        return self.__class__(self.data - self._operand(rhs))
+
+    def scale(self, s):
+        """ Multiply by a scalar, one scalar per vector (sequence of N) or
+        componentwise by a vector or VectorArray """
+        if isinstance(s, (Vector2, Vector3, VectorArray)):
+            return self.__class__(self.data * self._operand(s))
+        s = np.asarray(s, np.float32)
+        if s.ndim == 1:
+            s = s[:,np.newaxis]
+        return self.__class__(self.data * s)
+
+    __add__ = add
+    __sub__ = sub
+    __mul__ = scale
+
+    def length_squared(self):
+        return (self.data * self.data).sum(axis=1)
+
+    def length(self):
+        return np.sqrt(self.length_squared())
+
+    def normalize(self):
+        """ Unit vectors, zero length vectors stay zero """
+        l = self.length()
+        l[l == 0] = 1
+        return self.__class__(self.data / l[:,np.newaxis])
+
+    def lerp(self, other, s):
+        d = self._operand(other)
+        return self.__class__(self.data + (d - self.data) * np.float32(s))
+
+    def distance(self, p):
+        """ Distance from each vector to the point p """
+        d = self.data - self._operand(p)
+        return np.sqrt((d * d).sum(axis=1))
+
+    def nearest(self, p):
+        """ Index of and distance to the vector closest to p, None if empty """
+        if len(self.data) == 0:
+            return None
+        d = self.distance(p)
+        i = int(np.argmin(d))
+        return i, float(d[i])
+
+    def within(self, p, radius):
+        """ Indices of the vectors closer than radius (scalar or one per vector) to p """
+        d = self.data - self._operand(p)
+        r = np.asarray(radius, np.float32)
+        return np.flatnonzero((d * d).sum(axis=1) < r * r)
+
+class Vector2Array (VectorArray):
+    dim = 2
+    view = Vector2View
+
+class Vector3Array (VectorArray):
+    dim = 3
+    view = Vector3View
+
 # ------------------------------------------------------------------------------
 #
 # Unittesting
@@ -287,6 +531,72 @@ if __name__ == '__main__':
             self.assertAlmostEqual(s.x, 6.0)
             self.assertAlmostEqual(s.y, 10.0)
 
+        def test_mul_componentwise(self):
+            v = Vector2(1.0, 2.0) * (3.0, 4.0)
+            self.assertEqual(v.x, 3.0)
+            self.assertEqual(v.y, 8.0)
+            v = Vector2(1.0, 2.0) * Vector2(3.0, 4.0)
+            self.assertEqual(v.x, 3.0)
+            self.assertEqual(v.y, 8.0)
+
+        def test_mul_numpy_scalar(self):
+            import numpy as np
+            v = Vector2(1.0, 2.0) * np.float32(2)
+            self.assertEqual(v.x, 2.0)
+            self.assertEqual(v.y, 4.0)
+
+        def test_iadd(self):
+            v1 = Vector2(1.0, 2.0)
+            alias = v1
+            v2 = v1.iadd(Vector2(3.0, 4.0))
+            self.assertTrue(v2 is v1)
+            self.assertEqual(alias.x, 4.0)
+            self.assertEqual(alias.y, 6.0)
+
+        def test_add_is_not_inplace(self):
+            v1 = Vector2(1.0, 2.0)
+            alias = v1
+            v1 += Vector2(3.0, 4.0)
+            self.assertEqual(alias.x, 1.0)
+            self.assertEqual(alias.y, 2.0)
+
+        def test_imul(self):
+            v = Vector2(1.0, 2.0)
+            v.imul(2.0)
+            self.assertEqual(v.x, 2.0)
+            self.assertEqual(v.y, 4.0)
+            v.imul((0.5, 2.0))
+            self.assertEqual(v.x, 1.0)
+            self.assertEqual(v.y, 8.0)
+
+        def test_slots(self):
+            v = Vector2f(1.0, 2.0)
+            self.assertFalse(hasattr(v, '__dict__'))
+            self.assertRaises(AttributeError, setattr, v, 'z', 3.0)
+            self.assertRaises(AttributeError, getattr, v, 'z')
+
+        def test_subclass(self):
+            v = Vector2f(1.0, 2.0) + Vector2f(3.0, 4.0)
+            self.assertEqual(type(v), Vector2f)
+            self.assertEqual(type(v.copy()), Vector2f)
+
+        def test_segment_distance(self):
+            a = Vector2f(0,0)
+            b = Vector2f(10,0)
+            self.assertAlmostEqual(segment_distance(Vector2f(5,3), a, b), 3.0)
+            self.assertAlmostEqual(segment_distance(Vector2f(-4,3), a, b), 5.0)
+            self.assertAlmostEqual(segment_distance(Vector2f(13,4), a, b), 5.0)
+            self.assertAlmostEqual(segment_distance(Vector2f(3,4), a, a), 5.0)
+
+        def test_segment_distance_many(self):
+            a = np.array([(0,0), (0,0), (3,4), (-1,2)], np.float32).T
+            b = np.array([(10,0), (0,0), (3,4), (2,-5)], np.float32).T
+            for p in [(5,3), (-4,3), (13,4), (3,4)]:
+                d = segment_distance_many(p, a, b)
+                for i in range(a.shape[1]):
+                    expected = segment_distance(Vector2f(*p), Vector2f(*a[:,i]), Vector2f(*b[:,i]))
+                    self.assertAlmostEqual(d[i], expected, places=5)
+
     class test_vector3(unittest.TestCase):
         def test_constructor_empty(self):
             v = Vector3()
@@ -408,6 +718,16 @@ if __name__ == '__main__':
             for g,e in zip(v, expected):
                 self.assertAlmostEqual(g,e)
 
+        def test_iadd(self):
+            v = Vector3(1.0, 2.0, 3.0)
+            alias = v
+            v.iadd(Vector3(1.0, 1.0, 1.0)).imul(2.0)
+            self.assertEqual(alias.xyz, (4.0, 6.0, 8.0))
+
+        def test_slots(self):
+            v = Vector3f(1.0, 2.0, 3.0)
+            self.assertFalse(hasattr(v, '__dict__'))
+
     class test_vector2_datatypes(unittest.TestCase):
         def test_int(self):
             v = Vector2i(1,2)
@@ -440,6 +760,79 @@ if __name__ == '__main__':
             self.assertEqual(type(v2.x), int)
             self.assertEqual(type(v2.y), int)
 
+        def test_int_ops(self):
+            v = Vector2i(3, 5) * 0.5
+            self.assertEqual(type(v), Vector2i)
+            self.assertEqual(type(v.x), int)
+            self.assertEqual(v.xy, (1, 2))
+
+        def test_int3(self):
+            v = Vector3i(1.5, 2.5, 3.5)
+            self.assertEqual(type(v.x), int)
+            self.assertEqual(v.xyz, (1, 2, 3))
+
+    class test_vector_array(unittest.TestCase):
+        def test_constructor(self):
+            a = Vector2Array([Vector2f(1, 2), (3, 4)])
+            self.assertEqual(len(a), 2)
+            self.assertEqual(a.data.dtype, np.float32)
+            self.assertEqual(Vector3Array(5).data.shape, (5, 3))
+
+        def test_shared_buffer(self):
+            buf = np.zeros((3, 2), np.float32)
+            a = Vector2Array(buf)
+            a[1] = Vector2f(5, 6)
+            self.assertEqual(tuple(buf[1]), (5.0, 6.0))
+
+        def test_view(self):
+            a = Vector2Array([(1, 2), (3, 4)])
+            v = a[1]
+            self.assertTrue(isinstance(v, Vector2f))
+            self.assertEqual(v.xy, (3.0, 4.0))
+            self.assertAlmostEqual(v.length(), 5.0)
+
+            # writes go to the buffer, results are plain vectors
+            v.x = 7
+            v.iadd(Vector2f(1, 1))
+            self.assertEqual(tuple(a.data[1]), (8.0, 5.0))
+            w = v + Vector2f(1, 1)
+            self.assertEqual(type(w), Vector2f)
+            self.assertEqual(type(v.copy()), Vector2f)
+            self.assertEqual(tuple(a.data[1]), (8.0, 5.0))
+
+        def test_view3(self):
+            a = Vector3Array([(1, 2, 3)])
+            v = a[0]
+            v.z = 5
+            self.assertEqual(a[0].xyz, (1.0, 2.0, 5.0))
+            self.assertEqual(type(v * 2), Vector3f)
+
+        def test_ops(self):
+            a = Vector2Array([(1, 2), (3, 4)])
+            b = Vector2Array([(1, 1), (2, 2)])
+            self.assertEqual((a + b).data.tolist(), [[2, 3], [5, 6]])
+            self.assertEqual((a - Vector2f(1, 2)).data.tolist(), [[0, 0], [2, 2]])
+            self.assertEqual((a * 2).data.tolist(), [[2, 4], [6, 8]])
+            self.assertEqual(a.scale([1, 0.5]).data.tolist(), [[1, 2], [1.5, 2]])
+            self.assertEqual(a.scale(Vector2f(1, 0.5)).data.tolist(), [[1, 1], [3, 2]])
+            self.assertEqual(a.lerp(b, 0.5).data.tolist(), [[1, 1.5], [2.5, 3]])
+
+        def test_length(self):
+            a = Vector2Array([(3, 4), (0, 0)])
+            self.assertEqual(a.length().tolist(), [5.0, 0.0])
+            n = a.normalize()
+            self.assertAlmostEqual(n[0].length(), 1.0, 5)
+            self.assertEqual(n[1].xy, (0.0, 0.0))
+
+        def test_queries(self):
+            a = Vector2Array([(0, 0), (10, 0), (3, 4)])
+            i, d = a.nearest(Vector2f(4, 4))
+            self.assertEqual(i, 2)
+            self.assertAlmostEqual(d, 1.0)
+            self.assertEqual(a.within(Vector2f(0, 0), 5.5).tolist(), [0, 2])
+            self.assertEqual(a.within(Vector2f(0, 0), [1, 20, 1]).tolist(), [0, 1])
+            self.assertEqual(Vector2Array(0).nearest(Vector2f(0, 0)), None)
+
     # I always miss this function, but there is probably a better way which I've
     # missed. I hope.
     def getTestsFromTestCases(self, names):
@@ -449,5 +842,5 @@ if __name__ == '__main__':
         return self.suiteClass(cases)
     unittest.TestLoader.getTestsFromTestCases = getTestsFromTestCases
 
-    suite = unittest.TestLoader().getTestsFromTestCases([test_vector2, test_vector3, test_vector2_datatypes])
+    suite = unittest.TestLoader().getTestsFromTestCases([test_vector2, test_vector3, test_vector2_datatypes, test_vector_array])
     unittest.TextTestRunner(verbosity=2).run(suite)